@@ -0,0 +1,188 @@
+import argparse
+import asyncio
+import os
+import psycopg2
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append("..")
+
+from client import TwoPhaseCommitClient, by_key
+from local_storage import SQLiteDataStore
+from nodes.coordinator import TwoPhaseCommitCoordinator
+from nodes.logs import configure_logging
+from nodes.participant import TwoPhaseCommitParticipant
+from nodes.storage import MemoryLog, location, open_data_store, open_log_store
+
+UPSERT = "insert into data (sensor_id, measurement) values (%s, %s) on conflict (sensor_id) do update set measurement = excluded.measurement"
+FAILING = "insert into data (sensor_id, measurement) values (%s, null)" # violates "measurement not null"
+
+def postgres_available(dsn):
+    try:
+        psycopg2.connect(dsn).close()
+        return True
+    except psycopg2.Error:
+        return False
+
+def make_log_store(args, node_name, data_dir):
+    # Each node needs its own log; "{node}" in --log-db is replaced by "coordinator" or the participant's node ID.
+    # Local logs can be put in the benchmark's temporary directory with "{dir}", e.g. file:{dir}/log{node}.
+    if args.log_db:
+        return open_log_store(args.log_db.format(node=node_name, dir=data_dir))
+    return MemoryLog(write_delay=args.log_write_delay)
+
+def make_data_store(args, node_id, data_dir):
+    if args.data_db:
+        url = args.data_db.format(node=node_id, dir=data_dir)
+        if url.startswith("sqlite:"):
+            return SQLiteDataStore(location(url), size=args.max_connections)
+        if postgres_available(url):
+            return open_data_store(url, size=args.max_connections)
+        print(f"PostgreSQL at {url} is not available; using SQLite for participant {node_id}.", file=sys.stderr)
+    return SQLiteDataStore(os.path.join(data_dir, f"data{node_id}.db"), size=args.max_connections)
+
+async def start_cluster(args, data_dir):
+    hostname = "localhost"
+    coordinator_hosts = [(hostname, args.base_port + i) for i in range(args.coordinators)]
+    # Participants added by --add-participants run from the start, but coordinators only learn about them when rebalancing.
+    participant_hosts = [(hostname, args.base_port + args.coordinators + i) for i in range(args.participants + args.add_participants)]
+    nodes = []
+    for shard, (_, port) in enumerate(coordinator_hosts):
+        name = "coordinator" if args.coordinators == 1 else f"coordinator{shard}"
+        coordinator = TwoPhaseCommitCoordinator(make_log_store(args, name, data_dir), hostname, port, participant_hosts[:args.participants], timeout=args.timeout)
+        coordinator.inline_votes = args.inline_votes
+        coordinator.one_phase = not args.no_one_phase
+        coordinator.shard = shard
+        coordinator.shards = args.coordinators
+        nodes.append(coordinator)
+    for node_id, (_, port) in enumerate(participant_hosts):
+        participant = TwoPhaseCommitParticipant(node_id, make_data_store(args, node_id, data_dir), make_log_store(args, node_id, data_dir), hostname, port, coordinator_hosts, timeout=args.timeout, peers=[host for host in participant_hosts if host[1] != port])
+        nodes.append(participant)
+    for node in nodes:
+        node.presumption = args.presumption
+        node.log_writer.flush_window = args.log_flush_window
+        await node.setup()
+    # Participants start first, since the coordinators' recovery may need to reach them.
+    for node in reversed(nodes):
+        await node.start()
+    return nodes
+
+async def stop_cluster(nodes):
+    for node in reversed(nodes):
+        await node.stop()
+        if isinstance(node, TwoPhaseCommitParticipant):
+            node.data_store.close()
+
+def make_transaction(args, rng):
+    statements = []
+    single = rng.randrange(args.participants) if rng.random() < args.single_participant_rate else None
+    for i in range(args.batch_size):
+        key = f"sensor{rng.randrange(args.keys)}"
+        target = by_key(key) if args.route_by_key else single if single is not None else rng.randrange(args.participants)
+        statements.append((target, UPSERT, (key, rng.randrange(1000))))
+    if rng.random() < args.abort_rate:
+        statements[-1] = (statements[-1][0], FAILING, (statements[-1][2][0],))
+    return statements
+
+async def rebalance(args, client, nodes):
+    added = [(node.server.server_host, node.server.server_port) for node in nodes if isinstance(node, TwoPhaseCommitParticipant)][args.participants:]
+    start = time.perf_counter()
+    moved = await client.rebalance(add=added)
+    print(f"Rebalanced onto {len(added)} new participants in {time.perf_counter() - start:.2f}s while under load: {moved}.")
+
+async def run_load(args, client, halfway=None):
+    rng = random.Random(args.seed)
+    latencies = []
+    outcomes = {True: 0, False: 0, None: 0}
+    remaining = args.transactions
+    background = []
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            if halfway and remaining == args.transactions // 2:
+                background.append(asyncio.ensure_future(halfway()))
+            statements = make_transaction(args, rng)
+            start = time.perf_counter()
+            committed = await client.submit(statements)
+            latencies.append(time.perf_counter() - start)
+            outcomes[committed] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    await asyncio.gather(*background)
+    return time.perf_counter() - start, latencies, outcomes
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def report(args, duration, latencies, outcomes, nodes):
+    messages = sum(node.messages_sent for node in nodes)
+    log_forces = sum(node.log_forces for node in nodes)
+    frames = sum(node.frames_sent() for node in nodes)
+    log_flushes = sum(node.log_writer.flush_count for node in nodes)
+    print(f"{args.transactions} transactions of {args.batch_size} statements on {args.participants} participants and {args.coordinators} coordinators, concurrency {args.concurrency}, abort rate {args.abort_rate}.")
+    print(f"Throughput:   {args.transactions / duration:10.1f} transactions/s")
+    print(f"Latency p50:  {percentile(latencies, 0.5) * 1000:10.2f} ms")
+    print(f"Latency p99:  {percentile(latencies, 0.99) * 1000:10.2f} ms")
+    print(f"Committed:    {outcomes[True]:10d}")
+    print(f"Aborted:      {outcomes[False]:10d}")
+    print(f"No reply:     {outcomes[None]:10d}")
+    print(f"Messages:     {messages / args.transactions:10.2f} per transaction between nodes")
+    print(f"Frames:       {frames / args.transactions:10.2f} per transaction, including replies and heartbeats")
+    print(f"Log forces:   {log_forces / args.transactions:10.2f} per transaction ({log_flushes} flushes in total)")
+    for node in nodes:
+        for phase, latency in sorted(node.metrics.snapshot()["latencies"].items()):
+            print(f"  {node.metrics.node:>15} {phase:<13} p50 {latency['p50'] * 1000:8.2f} ms  p99 {latency['p99'] * 1000:8.2f} ms  ({latency['count']})")
+
+async def main():
+    argparser = argparse.ArgumentParser(description="Run a coordinator and participants in-process and measure commit throughput and latency.")
+    argparser.add_argument("--participants", type=int, default=2)
+    argparser.add_argument("--route-by-key", action="store_true", help="let the coordinator route statements to the participant owning their key")
+    argparser.add_argument("--add-participants", type=int, default=0, help="participants added by rebalancing halfway through the load; implies --route-by-key")
+    argparser.add_argument("--coordinators", type=int, default=1, help="coordinators sharing the participants, each owning a shard of the transaction IDs")
+    argparser.add_argument("--transactions", type=int, default=500)
+    argparser.add_argument("--concurrency", type=int, default=8)
+    argparser.add_argument("--batch-size", type=int, default=3)
+    argparser.add_argument("--abort-rate", type=float, default=0.0)
+    argparser.add_argument("--keys", type=int, default=10000)
+    argparser.add_argument("--seed", type=int, default=0)
+    argparser.add_argument("--base-port", type=int, default=17000)
+    argparser.add_argument("--timeout", type=int, default=10)
+    argparser.add_argument("--max-connections", type=int, default=10)
+    argparser.add_argument("--inline-votes", action="store_true")
+    argparser.add_argument("--no-one-phase", action="store_true", help="run two-phase commit even for transactions with a single participant")
+    argparser.add_argument("--single-participant-rate", type=float, default=0.0, help="fraction of transactions whose statements all go to one participant (without --route-by-key)")
+    argparser.add_argument("--presumption", choices=["abort", "commit"])
+    argparser.add_argument("--log-flush-window", type=float, default=0.002)
+    argparser.add_argument("--log-write-delay", type=float, default=0.0, help="simulated flush time of the in-memory log")
+    argparser.add_argument("--log-db", type=str, help="log store URL (postgresql://..., sqlite:PATH, file:PATH, mmap:PATH), with {node} replaced per node and {dir} by a temporary directory; in-memory log if omitted")
+    argparser.add_argument("--data-db", type=str, help="data store URL (postgresql://... or sqlite:PATH), with {node} replaced by the participant's node ID; SQLite if omitted or PostgreSQL is unavailable")
+    argparser.add_argument("--verbose", action="store_true", help="log every message of the nodes")
+    args = argparser.parse_args()
+    if args.add_participants:
+        if args.coordinators > 1:
+            argparser.error("--add-participants needs a single coordinator, which owns the partition map.")
+        args.route_by_key = True
+
+    log_listener = configure_logging("DEBUG" if args.verbose else "WARNING")
+    with tempfile.TemporaryDirectory() as data_dir:
+        nodes = await start_cluster(args, data_dir)
+        try:
+            client = TwoPhaseCommitClient("localhost", args.base_port, timeout=args.timeout)
+            for shard in range(1, args.coordinators):
+                client.add_coordinator("localhost", args.base_port + shard)
+            halfway = (lambda: rebalance(args, client, nodes)) if args.add_participants else None
+            duration, latencies, outcomes = await run_load(args, client, halfway)
+            await client.close()
+        finally:
+            await stop_cluster(nodes)
+    log_listener.stop()
+    report(args, duration, latencies, outcomes, nodes)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,72 @@
+import argparse
+import asyncio
+import psycopg2
+import sys
+import time
+
+sys.path.append("..")
+
+from nodes.log_writer import GroupCommitLogWriter
+from nodes.storage import PostgresLog
+
+STATUSES = ["PREPARED", "COMMITTED", "DONE"]
+
+def write_direct(log_db, trans_id, status):
+    # One synchronous transaction per state change, as in TwoPhaseCommitNode before group commit.
+    with log_db:
+        with log_db.cursor() as cur:
+            cur.execute("insert into log (transaction_id, status) values(%s, %s) on conflict (transaction_id) do update set status = %s", (trans_id, status, status))
+
+async def run_direct(log_db, transactions, concurrency):
+    async def worker(worker_id):
+        for trans_id in range(worker_id, transactions, concurrency):
+            for status in STATUSES:
+                write_direct(log_db, trans_id, status)
+                await asyncio.sleep(0)
+    await asyncio.gather(*[worker(i) for i in range(concurrency)])
+
+async def run_group_commit(writer, transactions, concurrency):
+    async def worker(worker_id):
+        for trans_id in range(worker_id, transactions, concurrency):
+            for status in STATUSES:
+                await writer.write(trans_id, status)
+    await asyncio.gather(*[worker(i) for i in range(concurrency)])
+
+def reset_log(log_db):
+    with log_db:
+        with log_db.cursor() as cur:
+            cur.execute("create table if not exists log (transaction_id int not null primary key, status varchar(20) not null)")
+            cur.execute("delete from log")
+
+async def main():
+    argparser = argparse.ArgumentParser(description="Compare per-transition log commits against group commit. Use a scratch database: the log table is cleared.")
+    argparser.add_argument("--log-db", type=str, required=True)
+    argparser.add_argument("--transactions", type=int, default=2000)
+    argparser.add_argument("--concurrency", type=int, default=32)
+    argparser.add_argument("--flush-window", type=float, default=0.002)
+    argparser.add_argument("--max-batch-size", type=int, default=128)
+    args = argparser.parse_args()
+    log_db = psycopg2.connect(args.log_db)
+    try:
+        reset_log(log_db)
+        start = time.perf_counter()
+        await run_direct(log_db, args.transactions, args.concurrency)
+        direct_duration = time.perf_counter() - start
+
+        reset_log(log_db)
+        log_store = PostgresLog(log_db)
+        writer = GroupCommitLogWriter(log_store, flush_window=args.flush_window, max_batch_size=args.max_batch_size)
+        start = time.perf_counter()
+        await run_group_commit(writer, args.transactions, args.concurrency)
+        group_duration = time.perf_counter() - start
+        reset_log(log_db)
+        log_store.close() # also closes log_db
+    finally:
+        log_db.close()
+
+    print(f"{args.transactions} transactions, {len(STATUSES)} log writes each, concurrency {args.concurrency}.")
+    print(f"Direct:       {args.transactions / direct_duration:10.1f} decisions/s ({args.transactions * len(STATUSES)} commits)")
+    print(f"Group commit: {args.transactions / group_duration:10.1f} decisions/s ({writer.flush_count} commits, window {args.flush_window}s)")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,91 @@
+import sqlite3
+from nodes.database import ConnectionPool
+from nodes.storage import StorageError, UnknownTransactionError
+
+class SQLiteDataStore:
+    # Local stand-in for PostgreSQL, for benchmarks only. SQLite locks the whole database for writing and has no
+    # prepared transactions, so statements are only checked against the current data when executed, and are applied
+    # together when the prepared transaction commits. Transactions are not isolated from each other, and prepared
+    # transactions do not survive a restart, so a participant using it can break atomicity.
+
+    def __init__(self, path, size=10, busy_timeout=5):
+        self.path = path
+        self.busy_timeout = busy_timeout # seconds to wait for the write lock held by another connection
+        self.pool = ConnectionPool(self.connect, size)
+        self.prepared = {} # transaction_id -> statements of a prepared transaction
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+
+    async def initialize(self):
+        connection = await self.pool.acquire()
+        try:
+            await connection.execute("pragma journal_mode=wal")
+        except sqlite3.Error as e:
+            raise StorageError(str(e)) from e
+        finally:
+            self.pool.release(connection)
+        await self.run([("create table if not exists data(sensor_id varchar(255) not null primary key, measurement int not null)", None)], True)
+
+    async def begin(self):
+        return SQLiteSession(self)
+
+    async def commit_prepared(self, trans_id):
+        if trans_id not in self.prepared:
+            raise UnknownTransactionError(f"Prepared transaction {trans_id} does not exist.")
+        await self.run(self.prepared.pop(trans_id), True)
+
+    async def rollback_prepared(self, trans_id):
+        if trans_id not in self.prepared:
+            raise UnknownTransactionError(f"Prepared transaction {trans_id} does not exist.")
+        del self.prepared[trans_id]
+
+    async def run(self, statements, commit):
+        # Runs (query, args) statements in one transaction, which is rolled back unless commit is set.
+        # Returns the rows of the last statement.
+        def run_statements(cur):
+            cur.execute("begin immediate")
+            try:
+                for query, args in statements:
+                    # Queries are written for psycopg2's %s placeholders.
+                    cur.execute(query.replace("%s", "?"), args or ())
+                rows = cur.fetchall()
+            except sqlite3.Error:
+                cur.execute("rollback")
+                raise
+            cur.execute("commit" if commit else "rollback")
+            return rows
+        connection = await self.pool.acquire()
+        try:
+            return await connection.run(run_statements, connection.cur)
+        except sqlite3.Error as e:
+            raise StorageError(str(e)) from e
+        finally:
+            self.pool.release(connection)
+
+    def close(self):
+        self.pool.close()
+
+class SQLiteSession:
+
+    def __init__(self, store):
+        self.store = store
+        self.statements = [] # (query, args) executed so far
+
+    async def execute(self, query, args=None):
+        await self.store.run([(query, args)], False)
+        self.statements.append((query, args))
+
+    async def query(self, query, args=None):
+        # Sees the committed data and this session's earlier statements, which are run again first.
+        return await self.store.run(self.statements + [(query, args)], False)
+
+    async def prepare(self, trans_id):
+        self.store.prepared[trans_id] = self.statements
+
+    async def commit(self):
+        if self.statements:
+            await self.store.run(self.statements, True)
+
+    async def abort(self):
+        pass
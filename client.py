@@ -2,6 +2,7 @@ import asyncio
 import argparse
 
 from simplyrpc import RemoteCallClient
+from nodes.rpc import PeerConnection
 
 def hostname_port_type(inp):
     if ":" in inp:
@@ -11,6 +12,83 @@ def hostname_port_type(inp):
         port = 12345
     return hostname, int(port)
 
+def by_key(sensor_id):
+    # Target of a statement that the coordinator routes to the participant owning sensor_id, instead of a node ID.
+    return {"key": sensor_id}
+
+class TwoPhaseCommitClient:
+
+    def __init__(self, hostname, port, timeout=10):
+        # Requests share one multiplexed connection per coordinator, so many can be in flight at once.
+        self.timeout = timeout
+        self.coordinators = [PeerConnection(hostname, port, timeout)]
+        self.next_coordinator = 0
+
+    def add_coordinator(self, hostname, port):
+        # New transactions are spread over all coordinators sharing the participants, in turn.
+        self.coordinators.append(PeerConnection(hostname, port, self.timeout))
+
+    def pick_coordinator(self):
+        coordinator = self.coordinators[self.next_coordinator]
+        self.next_coordinator = (self.next_coordinator + 1) % len(self.coordinators)
+        return coordinator
+
+    async def request(self, kind, data=None, coordinator=None):
+        return await (coordinator or self.coordinators[0]).request(kind, data)
+
+    async def close(self):
+        for coordinator in self.coordinators:
+            await coordinator.close()
+
+    async def begin(self):
+        # The transaction stays with the coordinator that began it.
+        coordinator = self.pick_coordinator()
+        trans_id = await self.request("BEGIN", coordinator=coordinator)
+        if trans_id is None:
+            return None
+        return Transaction(self, trans_id, coordinator)
+
+    def submit(self, statements):
+        # Runs a whole transaction of (node_id or by_key(sensor_id), query, args) statements in one request.
+        # Returns a future resolved with True if it committed, False if it aborted and None if the coordinator did not reply.
+        return asyncio.ensure_future(self.run_batch(statements))
+
+    async def rebalance(self, add=(), remove=()):
+        # Adds participants (hostname, port) and retires node IDs, then evens out the partitions over the
+        # participants. Returns {"moved": ..., "failed": ...} partition counts.
+        return await self.request("REBALANCE", {"add": [list(host) for host in add], "remove": list(remove)})
+
+    async def run_batch(self, statements):
+        reply = await self.request("EXECUTE_BATCH", {"statements": [list(statement) for statement in statements], "commit": True}, self.pick_coordinator())
+        if not reply:
+            return None
+        return reply["committed"]
+
+class Transaction:
+
+    def __init__(self, client, trans_id, coordinator):
+        self.client = client
+        self.trans_id = trans_id
+        self.coordinator = coordinator
+
+    async def request(self, kind, data):
+        return await self.client.request(kind, data, self.coordinator)
+
+    async def execute(self, node_id, query, args=tuple()):
+        return await self.request("EXECUTE", {"trans_id": self.trans_id, "node_id": node_id, "query": query, "args": args})
+
+    async def execute_batch(self, statements):
+        reply = await self.request("EXECUTE_BATCH", {"trans_id": self.trans_id, "statements": [list(statement) for statement in statements]})
+        if not reply:
+            return [False] * len(statements)
+        return reply["results"]
+
+    async def commit(self):
+        return await self.request("COMMIT", {"trans_id": self.trans_id})
+
+    async def abort(self):
+        return await self.request("ABORT", {"trans_id": self.trans_id})
+
 async def send_execute_request(coordinator, node_id, query, args=tuple()):
     kind = "EXECUTE"
     data = {"node_id": node_id,
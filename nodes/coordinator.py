@@ -1,197 +1,809 @@
 import asyncio
 import concurrent.futures
-from simplyrpc import RemoteCallClient
+import logging
+import time
 from nodes.node import TwoPhaseCommitNode
+from nodes.partitioning import load_partition_map, partition_map_from_json, save_partition_map
+from nodes.recovery import BatchSender, Recovery
+
+log = logging.getLogger(__name__)
+
+# Inserts the rows of a partition on its new owner while rebalancing.
+IMPORT = "insert into data (sensor_id, measurement) values (%s, %s) on conflict (sensor_id) do update set measurement = excluded.measurement"
+PARTITION_POLL_INTERVAL = 0.01 # seconds between checks whether a partition about to move is still in use
+IDLE_CHECK_INTERVAL = 1 # seconds between checks for idle client transactions
+TRANS_ID_BLOCK = 1000 # transaction IDs reserved in the log at a time
+
+class TransactionContext:
+    # One per transaction that is not DONE yet, so it is kept small: participants, votes and acks are bitsets
+    # indexed by node ID, which makes recording a vote or an ack O(1), and the state is an index into STATES.
+    __slots__ = ["trans_id", "state_code", "participants", "exec_counter", "completing", "executions",
+                 "voted", "approved", "read_only", "vote_requests", "acks", "votes_complete", "outcome", "decided_at", "partitions",
+                 "open", "active_at", "unacknowledged"]
+
+    STATES = [None, "BEGUN", "PREPARED", "COMMITTED", "ABORTED", "DONE"]
+
+    def __init__(self, trans_id, participants, state=None):
+        self.trans_id = trans_id
+        self.state_code = self.STATES.index(state)
+        self.participants = 0 # bit i is set if node i takes part in the transaction
+        for node_id in participants:
+            self.add_participant(node_id)
+        self.exec_counter = 0
+        self.completing = False # no more EXECUTEs are accepted once set
+        self.executions = [] # EXECUTE sends that must finish before PREPARE
+        self.voted = 0 # nodes that voted
+        self.approved = 0 # nodes that voted COMMIT or READ_ONLY
+        self.read_only = 0 # nodes that voted READ_ONLY
+        self.vote_requests = None # node_id -> PREPARE_VOTE request, possibly still outstanding; only with inline votes
+        self.acks = 0 # nodes that sent DONE
+        self.votes_complete = None # future set once every participant voted, created by wait_for_votes
+        self.outcome = asyncio.get_running_loop().create_future() # True if committed, False if aborted
+        self.decided_at = None # time.perf_counter() of the decision
+        self.partitions = None # partitions touched by statements routed by key, if any
+        self.open = False # begun by a client's BEGIN, which may send EXECUTEs, COMMIT and ABORT for it
+        self.active_at = None # time.monotonic() of the client's last request for an open transaction
+        self.unacknowledged = False # set if an EXECUTE got no reply; its participant may or may not have run it
+
+    @property
+    def state(self):
+        return self.STATES[self.state_code]
+
+    @state.setter
+    def state(self, state):
+        self.state_code = self.STATES.index(state)
+
+    def add_participant(self, node_id):
+        self.participants |= 1 << node_id
+
+    def participant_ids(self):
+        return node_ids(self.participants)
+
+    def set_vote(self, node_id, vote):
+        bit = 1 << node_id
+        self.voted |= bit
+        if vote in ["COMMIT", "READ_ONLY"]:
+            self.approved |= bit
+        if vote == "READ_ONLY":
+            self.read_only |= bit
+        if self.votes_complete and self.everyone_voted() and not self.votes_complete.done():
+            self.votes_complete.set_result(None)
+
+    def everyone_voted(self):
+        return self.voted & self.participants == self.participants
+
+    async def wait_for_votes(self):
+        if not self.everyone_voted():
+            if not self.votes_complete:
+                self.votes_complete = asyncio.get_running_loop().create_future()
+            await self.votes_complete
+
+    def can_commit(self):
+        return self.approved & self.participants == self.participants
+
+    def phase_two_participants(self):
+        # Read-only participants released their resources when voting and take no part in the decision.
+        return node_ids(self.participants & ~self.read_only)
+
+    def set_ack(self, node_id):
+        self.acks |= 1 << node_id
+        phase_two = self.participants & ~self.read_only
+        return self.acks & phase_two == phase_two
+
+    def decide(self, commit):
+        if not self.outcome.done():
+            self.outcome.set_result(commit)
+            self.decided_at = time.perf_counter()
+
+def node_ids(bits):
+    # Node IDs of the set bits, in increasing order.
+    return [node_id for node_id in range(bits.bit_length()) if bits >> node_id & 1]
 
 class TwoPhaseCommitCoordinator(TwoPhaseCommitNode):
 
-    def __init__(self, log_db_conn, own_hostname, own_port, participants, timeout=10):
-        super().__init__(log_db_conn, own_hostname, own_port)
-        self.participant_hosts = participants
-        self.participants = [] # List of RemoteCallClients
+    def __init__(self, log_store, own_hostname, own_port, participants, timeout=10):
+        super().__init__(log_store, own_hostname, own_port)
+        self.participant_hosts = list(participants)
+        self.participants = [] # PeerConnections, indexed by node ID
         self.timeout = timeout
-        self.current_trans_id = None
-        self.exec_counter = 0
         self.batch_size = 3
-        self.prepared_to_commit = {} # transaction_id -> [None, None, ...]
-        self.done = {} # transaction_id -> [False, False, ...]
-        self.everyone_prepared_event = None
+        self.inline_votes = False # collect votes from PREPARE_VOTE responses instead of PREPARE callbacks
+        self.one_phase = True # let the only participant of a transaction commit it alone, without preparing
+        self.contexts = {} # transaction_id -> TransactionContext, for transactions that are not DONE yet
+        self.open_transaction = None # TransactionContext receiving EXECUTEs until batch_size is reached
+        self.next_trans_id = None
+        self.reserved_trans_id = None # end of the block of IDs that may be handed out without logging; never used itself
+        self.reserving = None # task logging the next block
+        # Several coordinators can share the participants: coordinator `shard` of `shards` only allocates
+        # transaction IDs congruent to `shard` modulo `shards`, so their IDs never collide and participants
+        # can tell which coordinator owns a transaction.
+        self.shard = 0
+        self.shards = 1
+        # Statements given a key instead of a node ID are routed to the participant owning the key's partition.
+        self.partitioning = {"kind": "hash", "partitions": 64} # see nodes.partitioning.parse_partitioning
+        self.partition_map_path = None # file keeping the partition map across restarts, and each move while it commits
+        self.partition_map = None
+        self.partition_load = [] # statements routed to each partition since the last rebalancing
+        self.migrations = {} # partition -> future set once the partition has moved, or failed to
+        self.rebalancing = asyncio.Lock()
+        # Transactions acknowledged by every participant are only marked DONE in memory; a background task removes
+        # their contexts and logs them every collection_interval seconds, and compacts the log once
+        # compaction_batch of them were collected since the last compaction.
+        self.finished = [] # transaction IDs
+        self.collection_interval = 0.1
+        self.compaction_batch = 10000
+        self.collected = 0
+        self.collection_task = None
+        self.recovery_batches = None # kind -> BatchSender, while recovering
+        # Transactions begun by a client are aborted after idle_timeout seconds without a request for them, so that
+        # an abandoned one does not hold the participants' connections and locks.
+        self.idle_timeout = 60
+        self.idle_task = None
+        self.metrics.gauge("transactions_finished", lambda: len(self.finished))
+        self.metrics.gauge("transactions_in_flight", lambda: len(self.contexts))
 
     async def setup(self):
         for hostname, port in self.participant_hosts:
-            participant = RemoteCallClient(hostname, port)
-            participant.timeout = self.timeout
-            self.participants.append(participant)
-        self.server.register_handler("PREPARE", self.recv_prepare)
-        self.server.register_handler("DONE", self.recv_done)
-        self.server.register_handler("EXECUTE", self.recv_execute)
-        self.everyone_prepared_event = asyncio.Event()
-        self.initialize_log()
+            self.participants.append(self.connections.peer(hostname, port, self.timeout))
+        if self.partition_map_path:
+            self.partition_map = load_partition_map(self.partition_map_path)
+        if not self.partition_map:
+            self.partition_map = partition_map_from_json(self.partitioning, range(len(self.participants)))
+        self.partition_load = [0] * len(self.partition_map.owners)
+        if self.partition_map.pending:
+            # A move was being committed when the coordinator stopped. Statements for the partition wait until
+            # recovery has found out whether it moved.
+            self.migrations[self.partition_map.pending[0]] = asyncio.get_running_loop().create_future()
+        self.register_handler("PREPARE", self.recv_prepare)
+        self.register_handler("DONE", self.recv_done)
+        self.register_handler("DONE_BATCH", self.recv_done_batch)
+        self.register_handler("EXECUTE", self.recv_execute)
+        self.register_handler("EXECUTE_BATCH", self.recv_execute_batch)
+        self.register_handler("BEGIN", self.recv_begin)
+        self.register_handler("COMMIT", self.recv_commit)
+        self.register_handler("ABORT", self.recv_abort)
+        self.register_handler("REBALANCE", self.recv_rebalance)
+        await self.initialize_log()
 
     async def start(self):
         await super().start()
         await self.recover()
+        self.collection_task = asyncio.create_task(self.collect_finished_periodically())
+        self.idle_task = asyncio.create_task(self.abort_idle_periodically())
+
+    async def stop(self):
+        if self.idle_task:
+            self.idle_task.cancel()
+            self.idle_task = None
+        if self.collection_task:
+            self.collection_task.cancel()
+            self.collection_task = None
+        await self.collect_finished()
+        await super().stop()
 
-    async def send_all(self, kind, data):
+    async def send_to(self, node_ids, kind, data):
         sends = []
         results = []
-        for participant in self.participants:
-            new_task = asyncio.create_task(participant.send_timeout(kind, data))
+        for node_id in node_ids:
+            participant = self.participants[node_id]
+            new_task = asyncio.create_task(self.send(participant, kind, data))
             sends.append(new_task)
         for send in sends:
             result = await send
             results.append(result)
         return results
 
-    def set_done(self, trans_id, node_id):
-        if trans_id not in self.done:
-            self.done[trans_id] = [False] * len(self.participants)
-        self.done[trans_id][node_id] = True
+    def get_context(self, trans_id):
+        # Contexts of recovered transactions include every participant, since the log does not record which took part.
+        if trans_id not in self.contexts:
+            self.contexts[trans_id] = TransactionContext(trans_id, range(len(self.participants)), self.transactions.get(trans_id))
+        return self.contexts[trans_id]
 
-    def has_none(self, lst):
-        return any([x is None for x in lst])
+    async def set_state(self, ctx, state, force=True):
+        await self.log_transition(ctx.trans_id, state, force)
+        ctx.state = state
 
-    def set_prepared(self, trans_id, node_id, prepared=True):
-        if trans_id not in self.prepared_to_commit:
-            self.prepared_to_commit[trans_id] = [None] * len(self.participants)
-        self.prepared_to_commit[trans_id][node_id] = prepared
-        if trans_id == self.current_trans_id and not self.has_none(self.prepared_to_commit[trans_id]):
-            self.everyone_prepared_event.set()
+    async def forget(self, trans_id):
+        # Transactions with the presumed outcome, or without any participant left in phase two, need no DONE acknowledgements.
+        if self.moving(trans_id):
+            self.finished.append(trans_id)
+            return
+        self.contexts.pop(trans_id, None)
+        await self.log_transition(trans_id, "DONE", force=False)
 
     async def recv_execute(self, data):
-        print("D Received EXECUTE.")
-        node_id = int(data["node_id"])
+        log.debug("D Received EXECUTE.")
+        target = {"key": data["key"]} if "key" in data else data["node_id"]
         query = str(data["query"])
         args = tuple(data["args"])
-        print(f"Received EXECUTE ({query}) with args {args} for node {node_id} request from client.")
-        return await self.execute(node_id, query, args)
-
-    async def execute(self, node_id, query, args):
-        print("D Executing.")
-        if self.exec_counter == 0:
-            began = self.begin_transaction()
-            if not began:
+        log.debug("Received EXECUTE (%s) with args %s for node %s request from client.", query, args, target)
+        if data.get("trans_id") is not None:
+            ctx = self.get_open_context(data["trans_id"])
+            if not ctx:
                 return False
-            print("D Began.")
-        participant = self.participants[node_id]
-        executed = await participant.send_timeout("EXECUTE", (self.current_trans_id, query, args))
-        if not executed:
-            print("EXECUTE did not reach destination node or was not successful.")
+            return await self.execute_in(ctx, target, query, args)
+        if self.refuse_new_transaction():
             return False
-        print("D Executed.")
-        print(f"Sent EXECUTE ({query}) to participant {node_id}.")
-        self.exec_counter += 1
-        if self.exec_counter == self.batch_size:
-            await self.complete_transaction()
+        return await self.execute(target, query, args)
+
+    async def recv_begin(self, data):
+        if self.refuse_new_transaction():
+            return None
+        await self.reserve_trans_ids()
+        ctx = self.begin_transaction()
+        ctx.open = True
+        ctx.active_at = time.monotonic()
+        log.debug("Received BEGIN from client; began transaction %s.", ctx.trans_id)
+        return ctx.trans_id
+
+    async def recv_execute_batch(self, data):
+        if data.get("trans_id") is None:
+            if self.refuse_new_transaction():
+                return False
+            await self.reserve_trans_ids()
+            ctx = self.begin_transaction()
+            ctx.open = True
+            ctx.active_at = time.monotonic()
+        else:
+            ctx = self.get_open_context(data["trans_id"])
+            if not ctx:
+                return False
+        statements = [(target, str(query), tuple(args)) for target, query, args in data["statements"]]
+        log.debug("Received EXECUTE_BATCH of %s statements for transaction %s from client.", len(statements), ctx.trans_id)
+        results = await self.execute_batch(ctx, statements)
+        committed = None
+        if data.get("commit") and not all(results):
+            # A statement that was rejected, or failed, cannot be committed with the others.
+            await self.abort_open(ctx)
+            committed = False
+        elif data.get("commit"):
+            committed = await self.finish_transaction(ctx)
+        return {"trans_id": ctx.trans_id, "results": results, "committed": committed}
+
+    async def recv_commit(self, data):
+        ctx = self.get_open_context(data["trans_id"])
+        if not ctx:
+            return False
+        log.debug("Received COMMIT for transaction %s from client.", ctx.trans_id)
+        return await self.finish_transaction(ctx)
+
+    async def recv_abort(self, data):
+        ctx = self.get_open_context(data["trans_id"])
+        if not ctx:
+            return False
+        log.debug("Received ABORT for transaction %s from client.", ctx.trans_id)
+        await self.abort_open(ctx)
         return True
 
-    def begin_transaction(self):
-        print("B Begin.")
-        if not self.current_trans_id:
-            if self.transactions.keys():
-                self.current_trans_id = max(self.transactions.keys())
-            else:
-                self.current_trans_id = 0
-        if (self.current_trans_id in self.transactions and self.transactions[self.current_trans_id] not in ["DONE", "PREPARED", "COMMITTED", "ABORTED"]):
-            print("May not BEGIN a new transaction; previous one has not completed yet.")
+    async def abort_open(self, ctx):
+        # Aborts a transaction that was begun but not completed.
+        ctx.completing = True
+        if self.open_transaction is ctx:
+            self.open_transaction = None
+        await asyncio.gather(*ctx.executions)
+        if not ctx.participants:
+            # No participant to tell, or to wait for a DONE from.
+            self.metrics.count("aborts")
+            ctx.decide(False)
+            await self.forget(ctx.trans_id)
+            return
+        await self.set_state(ctx, "ABORTED", force=self.presumption != "abort")
+        self.metrics.count("aborts")
+        ctx.decide(False)
+        await self.abort_transaction(ctx.trans_id)
+
+    def refuse_new_transaction(self):
+        # Transactions that already began may still finish while draining, but no new ones are started.
+        if self.draining:
+            log.info("Refusing new transaction; shutting down.")
+        return self.draining
+
+    def get_open_context(self, trans_id):
+        # Returns the context of a transaction that may still receive EXECUTEs, i.e. that was begun by a client but
+        # not completed. Recovered transactions and those batched from EXECUTEs without a trans_id are not open.
+        ctx = self.contexts.get(trans_id)
+        if not ctx or not ctx.open or ctx.completing:
+            log.warning("Transaction %s is unknown or already completing.", trans_id)
+            return None
+        ctx.active_at = time.monotonic()
+        return ctx
+
+    async def abort_idle_periodically(self):
+        while True:
+            await asyncio.sleep(IDLE_CHECK_INTERVAL)
+            idle_since = time.monotonic() - self.idle_timeout
+            idle = [ctx for ctx in self.contexts.values() if ctx.open and not ctx.completing and ctx.active_at < idle_since]
+            for ctx in idle:
+                log.warning("Aborting transaction %s; no request from its client for %ss.", ctx.trans_id, self.idle_timeout)
+            await asyncio.gather(*[self.abort_open(ctx) for ctx in idle])
+
+    async def execute(self, target, query, args):
+        log.debug("D Executing.")
+        if self.open_transaction is None:
+            await self.reserve_trans_ids()
+        ctx = self.open_transaction
+        if ctx is None:
+            ctx = self.begin_transaction()
+            self.open_transaction = ctx
+            log.debug("D Began %s.", ctx.trans_id)
+        ctx.exec_counter += 1
+        completes = ctx.exec_counter == self.batch_size
+        if completes:
+            # Later EXECUTEs go to a new transaction while this one is being committed.
+            self.open_transaction = None
+        executed = await self.execute_in(ctx, target, query, args)
+        if completes and not ctx.completing: # unless aborted while executing
+            await self.complete_transaction(ctx)
+        return executed
+
+    async def execute_in(self, ctx, target, query, args):
+        send = asyncio.ensure_future(self.send_execute(ctx, target, query, args))
+        ctx.executions.append(send)
+        with self.metrics.timed("execute"):
+            executed = await send
+        if not executed:
+            log.warning("EXECUTE did not reach destination node or was not successful.")
             return False
-        self.current_trans_id += 1
-        self.everyone_prepared_event.clear()
+        log.debug("D Executed.")
+        log.debug("Sent EXECUTE (%s) to participant %s.", query, target)
         return True
 
-    async def complete_transaction(self):
-        self.exec_counter = 0
-        trans_id = self.current_trans_id
-        self.transactions[trans_id] = "PREPARED"
-        self.write_log()
-        await self.prepare_transaction(trans_id)
+    async def send_execute(self, ctx, target, query, args):
+        node_id = await self.route(ctx, target)
+        if node_id is None:
+            return False
+        ctx.add_participant(node_id)
+        executed = await self.send(self.participants[node_id], "EXECUTE", (ctx.trans_id, query, args))
+        if executed is None:
+            ctx.unacknowledged = True
+        return executed
 
-    async def prepare_transaction(self, trans_id):
-        assert self.transactions[trans_id] == "PREPARED"
-        await self.send_all("PREPARE", trans_id)
-        print(f"Sent PREPARE {trans_id} to all participants.")
+    async def route(self, ctx, target):
+        # Returns the node ID of a statement's target: a node ID, or {"key": sensor_id} for the owner of the key.
+        # Statements for a partition that is being moved wait until it has moved. Returns None if there is no such
+        # participant, or if the transaction was aborted meanwhile.
+        if not isinstance(target, dict):
+            node_id = int(target)
+            if not 0 <= node_id < len(self.participants):
+                log.warning("Rejected statement for unknown participant %s in transaction %s.", node_id, ctx.trans_id)
+                return None
+            return node_id
+        partition = self.partition_map.partition(target["key"])
+        while partition in self.migrations and not ctx.outcome.done():
+            await asyncio.wait([self.migrations[partition], ctx.outcome], return_when=asyncio.FIRST_COMPLETED)
+        if ctx.outcome.done():
+            return None
+        self.partition_load[partition] += 1
+        if ctx.partitions is None:
+            ctx.partitions = set()
+        ctx.partitions.add(partition)
+        return self.partition_map.owners[partition]
+
+    async def execute_batch(self, ctx, statements):
+        # Statements for the same participant are sent together, in order, in one EXECUTE_BATCH message.
+        results = [False] * len(statements)
+        by_node = {}
+        for index, (target, query, args) in enumerate(statements):
+            node_id = await self.route(ctx, target)
+            if node_id is None:
+                return results
+            by_node.setdefault(node_id, []).append(index)
+
+        async def execute_on(node_id, indices):
+            send = asyncio.ensure_future(self.send(self.participants[node_id], "EXECUTE_BATCH", (ctx.trans_id, [statements[i][1:] for i in indices])))
+            ctx.executions.append(send)
+            with self.metrics.timed("execute"):
+                executed = await send
+            if executed is None:
+                ctx.unacknowledged = True
+            for i, result in zip(indices, executed or []):
+                results[i] = bool(result)
+
+        for node_id in by_node:
+            ctx.add_participant(node_id)
+        await asyncio.gather(*[execute_on(node_id, indices) for node_id, indices in by_node.items()])
+        return results
+
+    def owns(self, trans_id):
+        if trans_id % self.shards == self.shard:
+            return True
+        log.warning("Received message for transaction %s, which belongs to coordinator %s.", trans_id, trans_id % self.shards)
+        return pending is not None and pending[2] == trans_id
+
+    def first_trans_id(self):
+        # Smallest ID of this coordinator's shard above every ID in its log.
+        after = max(self.transactions.keys(), default=0) + 1
+        return after + (self.shard - after) % self.shards
+
+    async def reserve_trans_ids(self):
+        # Waits until begin_transaction may hand out an ID. IDs are reserved in blocks: the end of each block is
+        # logged, as a DONE transaction that never runs, before any ID below it is used. After a crash, IDs start
+        # above it, so none is reused while participants may still hold a BEGUN transaction with that ID.
+        if self.next_trans_id is None:
+            self.next_trans_id = self.first_trans_id()
+        while self.reserved_trans_id is None or self.next_trans_id >= self.reserved_trans_id:
+            if not self.reserving:
+                self.reserving = asyncio.ensure_future(self.log_reservation())
+            await asyncio.shield(self.reserving)
+
+    async def log_reservation(self):
         try:
-            await asyncio.wait_for(self.everyone_prepared_event.wait(), self.timeout)
-            do_commit = all(self.prepared_to_commit[self.current_trans_id])
-        except concurrent.futures.TimeoutError:
-            do_commit = False
-        if do_commit:
-            print(f"Every participant replied with PREPARED")
-            self.transactions[trans_id] = "COMMITTED"
-            self.write_log()
+            if self.next_trans_id == self.reserved_trans_id:
+                self.next_trans_id += self.shards
+            reserved_trans_id = self.next_trans_id + TRANS_ID_BLOCK * self.shards
+            await self.log_transition(reserved_trans_id, "DONE")
+            self.reserved_trans_id = reserved_trans_id
+        finally:
+            self.reserving = None
+
+    def begin_transaction(self):
+        # Call reserve_trans_ids first.
+        log.debug("B Begin.")
+        trans_id = self.next_trans_id
+        self.next_trans_id += self.shards
+        ctx = TransactionContext(trans_id, [])
+        self.contexts[trans_id] = ctx
+        return ctx
+
+    async def complete_transaction(self, ctx):
+        ctx.completing = True
+        await asyncio.gather(*ctx.executions)
+        if ctx.unacknowledged:
+            # Committing could lose the statements of an EXECUTE that never arrived.
+            log.warning("Aborting transaction %s; an EXECUTE got no reply.", ctx.trans_id)
+            await self.abort_open(ctx)
+            return
+        if not ctx.participants:
+            log.info("Aborting transaction %s; none of its statements reached a participant.", ctx.trans_id)
+            await self.abort_open(ctx)
+            return
+        if self.one_phase and ctx.participants and not ctx.participants & (ctx.participants - 1):
+            await self.commit_one_phase(ctx)
+            return
+        await self.set_state(ctx, "PREPARED")
+        await self.prepare_transaction(ctx.trans_id)
+
+    async def finish_transaction(self, ctx):
+        await self.complete_transaction(ctx)
+        return ctx.outcome.result()
+
+    async def commit_one_phase(self, ctx):
+        # With a single participant there is nothing to agree on: it commits or aborts the transaction alone and
+        # replies with the outcome. Nothing is forced to the log and no DONE is awaited; the unforced DONE entry only
+        # keeps transaction IDs increasing across restarts.
+        node_id = ctx.participant_ids()[0]
+        with self.metrics.timed("commit_one_phase"):
+            committed = await self.send(self.participants[node_id], "COMMIT_ONE_PHASE", ctx.trans_id)
+        if committed is None:
+            log.warning("No reply to one-phase COMMIT of transaction %s; its outcome is unknown.", ctx.trans_id)
+            self.metrics.count("one_phase_unknown")
+            ctx.outcome.set_result(None)
+        else:
+            self.metrics.count("one_phase_commits" if committed else "aborts")
+            ctx.decide(committed)
+        await self.forget(ctx.trans_id)
+
+    async def prepare_transaction(self, trans_id):
+        ctx = self.get_context(trans_id)
+        assert ctx.state == "PREPARED"
+        with self.metrics.timed("prepare_vote"):
+            if self.inline_votes:
+                do_commit = await self.collect_votes(ctx)
+            else:
+                do_commit = await self.wait_for_prepared(ctx)
+        if not ctx.phase_two_participants():
+            log.debug("Every participant of %s voted READ_ONLY.", trans_id)
+            self.metrics.count("read_only_transactions")
+            ctx.decide(True)
+            await self.forget(trans_id)
+        elif do_commit:
+            log.debug("Every participant replied with PREPARED")
+            await self.set_state(ctx, "COMMITTED")
+            self.metrics.count("commits")
+            ctx.decide(True)
             await self.commit_transaction(trans_id)
         else:
-            print(f"At least one participant replied with PREPARED ABORT or timed out before replying with a PREPARED message.")
-            self.transactions[trans_id] = "ABORTED"
-            self.write_log()
+            log.debug("At least one participant replied with PREPARED ABORT or timed out before replying with a PREPARED message.")
+            await self.set_state(ctx, "ABORTED", force=self.presumption != "abort")
+            self.metrics.count("aborts")
+            ctx.decide(False)
             await self.abort_transaction(trans_id)
 
-    async def recv_prepare(self, data):
-        node_id, trans_id, action = data
+    async def wait_for_prepared(self, ctx):
+        await self.send_to(ctx.participant_ids(), "PREPARE", ctx.trans_id)
+        log.debug("Sent PREPARE %s to participants %s.", ctx.trans_id, ctx.participant_ids())
+        unreachable = [node_id for node_id in ctx.participant_ids() if self.participants[node_id].down]
+        if unreachable:
+            # Their votes cannot arrive, so there is no point in waiting for the timeout.
+            log.warning("Participants %s are down.", unreachable)
+            self.metrics.count("unreachable_aborts")
+            return False
+        try:
+            await asyncio.wait_for(ctx.wait_for_votes(), self.timeout)
+            return ctx.can_commit()
+        except concurrent.futures.TimeoutError:
+            self.metrics.count("vote_timeouts")
+            return False
+
+    async def collect_votes(self, ctx):
+        # Decides to abort on the first ABORT vote or timeout, without waiting for the remaining votes.
+        # Outstanding requests are not cancelled; abort_transaction sends a participant's ABORT after its PREPARE_VOTE.
+        ctx.vote_requests = {}
+        for node_id in ctx.participant_ids():
+            ctx.vote_requests[node_id] = asyncio.ensure_future(self.request_vote(node_id, ctx.trans_id))
+        requests = list(ctx.vote_requests.values())
+        log.debug("Sent PREPARE_VOTE %s to participants %s.", ctx.trans_id, ctx.participant_ids())
+        try:
+            for request in asyncio.as_completed(requests, timeout=self.timeout):
+                node_id, vote = await request
+                ctx.set_vote(node_id, vote)
+                if vote not in ["COMMIT", "READ_ONLY"]:
+                    log.debug("Participant %s replied with %s.", node_id, vote)
+                    return False
+        except concurrent.futures.TimeoutError:
+            self.metrics.count("vote_timeouts")
+            return False
+        return True
+
+    async def request_vote(self, node_id, trans_id):
+        vote = await self.send(self.participants[node_id], "PREPARE_VOTE", trans_id)
+        return node_id, vote
 
-        if trans_id not in self.transactions:
-            print("PREPARE message for unknown transaction encountered.")
+    async def recv_prepare(self, data):
+        node_id, trans_id, action = data[:3]
+        if len(data) > 3:
+            # DONE acknowledgements of other transactions, sent along with the vote.
+            self.acknowledge_all(node_id, data[3])
+        if not self.owns(trans_id):
+            # Answering with the presumed outcome here could contradict the owner's decision.
             return False
 
-        state = self.transactions[trans_id]
+        state = self.transactions.get(trans_id)
+        if state in [None, "DONE"] and self.presumption:
+            state = "COMMITTED" if self.presumption == "commit" else "ABORTED"
+
+        if state is None:
+            log.warning("PREPARE message for unknown transaction encountered.")
+            return False
 
         if state == "COMMITTED":
-            print(f"Received PREPARED from participant {node_id} for transaction that has already committed previously.")
-            await self.participants[node_id].send_timeout("COMMIT", trans_id)
-            return
+            log.debug("Received PREPARED from participant %s for transaction that has already committed previously.", node_id)
+            await self.send(self.participants[node_id], "COMMIT", trans_id)
+            return True
 
         elif state == "ABORTED":
-            print(f"Received PREPARED from participant {node_id} for transaction that has already been aborted previously.")
-            await self.participants[node_id].send_timeout("ABORT", trans_id)
-            return
+            log.debug("Received PREPARED from participant %s for transaction that has already been aborted previously.", node_id)
+            await self.send(self.participants[node_id], "ABORT", trans_id)
+            return True
 
         elif state == "PREPARED":
-            self.set_prepared(trans_id, node_id, (action == "COMMIT"))
-            print(f"Received PREPARED {action} from participant {node_id}.")
+            self.get_context(trans_id).set_vote(node_id, action)
+            log.debug("Received PREPARED %s from participant %s.", action, node_id)
+            return True
 
         else:
-            print(f"Illegal PREPARE message received for transaction {trans_id} in state {state} from node {node_id}.")
+            log.warning("Illegal PREPARE message received for transaction %s in state %s from node %s.", trans_id, state, node_id)
             return
 
     async def commit_transaction(self, trans_id):
         assert self.transactions[trans_id] == "COMMITTED"
-        print(f"Sending COMMIT to all participants.")
-        await self.send_all("COMMIT", trans_id)
+        node_ids = self.get_context(trans_id).phase_two_participants()
+        log.debug("Sending COMMIT to participants %s.", node_ids)
+        with self.metrics.timed("commit"):
+            await self.send_to(node_ids, "COMMIT", trans_id)
+        if self.presumption == "commit":
+            await self.forget(trans_id)
 
     async def abort_transaction(self, trans_id):
         assert self.transactions[trans_id] == "ABORTED"
-        print(f"Sending ABORT to all participants.")
-        await self.send_all("ABORT", trans_id)
+        ctx = self.get_context(trans_id)
+        node_ids = ctx.phase_two_participants()
+        log.debug("Sending ABORT to participants %s.", node_ids)
+        with self.metrics.timed("abort"):
+            await asyncio.gather(*[self.send_after_vote(ctx, node_id, "ABORT") for node_id in node_ids])
+        if self.presumption == "abort":
+            await self.forget(trans_id)
+
+    async def send_after_vote(self, ctx, node_id, kind):
+        # A participant still preparing must not receive the decision before its vote is in.
+        if ctx.vote_requests and node_id in ctx.vote_requests:
+            await asyncio.wait([ctx.vote_requests[node_id]])
+        return await self.send(self.participants[node_id], kind, ctx.trans_id)
 
     async def recv_done(self, data):
         node_id, trans_id = data
-        if (trans_id in self.transactions and self.transactions[trans_id] not in ["DONE", "COMMITTED", "ABORTED"]):
-            print(f"Illegal DONE message received from node {node_id} for transaction {trans_id}.")
-            return
-        self.set_done(trans_id, node_id)
-        print(f"Received DONE from node {node_id}.")
-        if all(self.done[trans_id]):
-            print(f"Everyone DONE. Removing transaction {trans_id}.")
+        return self.acknowledge(node_id, trans_id)
+
+    async def recv_done_batch(self, data):
+        node_id, trans_ids = data
+        self.acknowledge_all(node_id, trans_ids)
+        return True
+
+    def acknowledge_all(self, node_id, trans_ids):
+        for trans_id in trans_ids:
+            self.acknowledge(node_id, trans_id)
+
+    def acknowledge(self, node_id, trans_id):
+        state = self.transactions.get(trans_id, "DONE") # unknown transactions were compacted after DONE
+        if state == "DONE":
+            return True
+        if state not in ["COMMITTED", "ABORTED"]:
+            log.warning("Illegal DONE message received from node %s for transaction %s.", node_id, trans_id)
+            return None
+        if not self.owns(trans_id):
+            return False
+        ctx = self.get_context(trans_id)
+        log.debug("Received DONE from node %s.", node_id)
+        if ctx.set_ack(node_id):
+            log.debug("Everyone DONE. Finished transaction %s.", trans_id)
+            if ctx.decided_at:
+                self.metrics.observe("done", time.perf_counter() - ctx.decided_at)
+            # Losing this before it is logged only means the decision is sent again after a restart.
+            ctx.state = "DONE"
             self.transactions[trans_id] = "DONE"
-            if trans_id in self.done:
-                del self.done[trans_id]
-            if trans_id in self.prepared_to_commit:
-                del self.prepared_to_commit[trans_id]
+            self.finished.append(trans_id)
         return True
 
+    async def collect_finished(self):
+        finished, self.finished = self.finished, []
+        for trans_id in finished:
+            if self.moving(trans_id):
+                self.finished.append(trans_id)
+                continue
+            self.contexts.pop(trans_id, None)
+            await self.log_transition(trans_id, "DONE", force=False)
+        self.collected += len(finished)
+        if self.collected >= self.compaction_batch:
+            self.collected = 0
+            await self.compact_log()
+
+    async def collect_finished_periodically(self):
+        while True:
+            await asyncio.sleep(self.collection_interval)
+            await self.collect_finished()
+
+    def moving(self, trans_id):
+        # The transaction of a pending move is not logged DONE until the move is settled, so that its outcome can
+        # still be read from the log after a crash.
+        pending = self.partition_map.pending
+        return pending is not None and pending[2] == trans_id
+
+    def settle_move(self, moved):
+        # Records in the partition map whether the pending move committed.
+        partition, target, _ = self.partition_map.pending
+        if moved:
+            self.partition_map.owners[partition] = target
+        self.partition_map.pending = None
+        if self.partition_map_path:
+            save_partition_map(self.partition_map, self.partition_map_path)
+
+    async def recv_rebalance(self, data):
+        # Adds participants ({"add": [[hostname, port], ...]}, which get the next node IDs) and moves partitions away
+        # from those in {"remove": [node_id, ...]}, then spreads the partitions evenly by the statements routed to
+        # them since the last rebalancing. Partitions move one at a time while transactions go on.
+        data = data or {}
+        if self.refuse_new_transaction():
+            return None
+        async with self.rebalancing:
+            for hostname, port in data.get("add", []):
+                self.participant_hosts.append((hostname, int(port)))
+                self.participants.append(self.connections.peer(hostname, int(port), self.timeout))
+            removed = set(data.get("remove", []))
+            node_ids = [node_id for node_id in range(len(self.participants)) if node_id not in removed]
+            owners = self.partition_map.rebalanced(node_ids, [load + 1 for load in self.partition_load])
+            moves = [(partition, source, owners[partition]) for partition, source in enumerate(self.partition_map.owners) if source != owners[partition]]
+            log.info("Rebalancing %s partitions over participants %s; moving %s.", len(owners), node_ids, len(moves))
+            moved = 0
+            for partition, source, target in moves:
+                if await self.migrate(partition, source, target):
+                    moved += 1
+            self.partition_load = [0] * len(self.partition_load)
+            log.info("Rebalancing done; moved %s of %s partitions.", moved, len(moves))
+            return {"moved": moved, "failed": len(moves) - moved}
+
+    async def migrate(self, partition, source, target):
+        # Moves a partition's rows from source to target in one transaction, and then updates the partition map.
+        # The move is written to the map file before it is committed, so that a restart after a crash settles it by
+        # the transaction's outcome. Returns whether it moved.
+        done = asyncio.get_running_loop().create_future()
+        self.migrations[partition] = done
+        try:
+            if not await self.wait_for_partition(partition):
+                log.warning("Partition %s is still in use; not moving it.", partition)
+                return False
+            await self.reserve_trans_ids()
+            ctx = self.begin_transaction()
+            ctx.add_participant(source)
+            export = asyncio.ensure_future(self.send(self.participants[source], "EXPORT", (ctx.trans_id, self.partition_map.describe(), partition)))
+            ctx.executions.append(export)
+            rows = await export
+            results = [rows is not None]
+            if rows:
+                results = await self.execute_batch(ctx, [(target, IMPORT, tuple(row)) for row in rows])
+            if not all(results):
+                await self.abort_open(ctx)
+                log.warning("Could not move partition %s from participant %s to %s.", partition, source, target)
+                return False
+            self.partition_map.pending = [partition, target, ctx.trans_id]
+            if self.partition_map_path:
+                save_partition_map(self.partition_map, self.partition_map_path)
+            committed = await self.finish_transaction(ctx)
+            self.settle_move(committed)
+            if not committed:
+                return False
+            self.metrics.count("partitions_moved")
+            log.info("Moved partition %s (%s rows) from participant %s to %s.", partition, len(rows), source, target)
+            return True
+        finally:
+            del self.migrations[partition]
+            done.set_result(None)
+
+    async def wait_for_partition(self, partition):
+        # Waits until every transaction that routed statements to the partition has finished at the participants,
+        # so that none writes to the old owner after its rows were moved. Those that are not completing after the
+        # timeout are aborted. Returns False if some are still not finished after another timeout.
+        deadline = time.monotonic() + self.timeout
+        aborted = False
+        while True:
+            holding = [ctx for ctx in self.contexts.values() if ctx.partitions and partition in ctx.partitions]
+            if not holding:
+                return True
+            if time.monotonic() >= deadline:
+                if aborted:
+                    return False
+                for ctx in holding:
+                    if not ctx.completing:
+                        log.warning("Aborting transaction %s, which holds partition %s being moved.", ctx.trans_id, partition)
+                        ctx.decide(False) # first, so that its statements waiting for this partition give up
+                        await self.abort_open(ctx)
+                aborted = True
+                deadline = time.monotonic() + self.timeout
+            await asyncio.sleep(PARTITION_POLL_INTERVAL)
+
     async def recover(self):
-        self.read_log()
-        print(f"Recovering. Read {len(self.transactions)} transactions from log.")
-        tasks = []
-        for trans_id, state in self.transactions.items():
-            task = None
-            if state == "PREPARED":
-                task = asyncio.create_task(self.prepare_transaction(trans_id))
-            elif state == "COMMITTED":
-                task = asyncio.create_task(self.commit_transaction(trans_id))
-            elif state == "ABORTED":
-                task = asyncio.create_task(self.abort_transaction(trans_id))
-            if task:
-                tasks.append(task)
-        for task in tasks:
-            await task
\ No newline at end of file
+        await self.read_log()
+        log.info("Recovering. Read %s transactions from log.", len(self.transactions))
+        self.next_trans_id = self.first_trans_id()
+        unfinished = [(trans_id, state) for trans_id, state in self.transactions.items() if state in ["PREPARED", "COMMITTED", "ABORTED"]]
+        self.metrics.count("recoveries", len(unfinished))
+        # The messages of concurrently recovering transactions are sent to each participant in batches.
+        self.recovery_batches = {kind: BatchSender(self, kind) for kind in ["PREPARE_VOTE", "COMMIT", "ABORT"]}
+        await Recovery(self.metrics, self.recovery_concurrency).run(unfinished, self.resolve)
+        if self.partition_map.pending:
+            # Its transaction was not logged DONE before the move was settled, so it is still known here if it committed.
+            partition, _, trans_id = self.partition_map.pending
+            committed = self.transactions.get(trans_id) == "COMMITTED"
+            log.info("Settling move of partition %s; %s.", partition, "it moved" if committed else "it did not move")
+            self.settle_move(committed)
+            self.migrations.pop(partition).set_result(None)
+
+    async def resolve(self, trans_id, state):
+        # Finishes a transaction found unfinished in the log. Recovered contexts include every participant.
+        ctx = self.get_context(trans_id)
+        if state == "PREPARED":
+            # No decision was made before the crash. With a presumption, aborting is always safe; otherwise the votes
+            # are collected again. A participant that is down, does not reply in time, or never took part votes ABORT.
+            commit = False
+            if not self.presumption:
+                node_ids = ctx.participant_ids()
+                for node_id, vote in zip(node_ids, await self.send_recovery_batches(node_ids, "PREPARE_VOTE", trans_id)):
+                    ctx.set_vote(node_id, vote)
+                commit = ctx.can_commit()
+            if commit and not ctx.phase_two_participants():
+                ctx.decide(True)
+                await self.forget(trans_id)
+                return
+            if commit:
+                await self.set_state(ctx, "COMMITTED")
+                self.metrics.count("commits")
+            else:
+                await self.set_state(ctx, "ABORTED", force=self.presumption != "abort")
+                self.metrics.count("aborts")
+            ctx.decide(commit)
+            state = ctx.state
+        await self.send_recovery_batches(ctx.phase_two_participants(), "COMMIT" if state == "COMMITTED" else "ABORT", trans_id)
+        if self.presumption and state == ("COMMITTED" if self.presumption == "commit" else "ABORTED"):
+            await self.forget(trans_id)
+
+    async def send_recovery_batches(self, node_ids, kind, trans_id):
+        return await asyncio.gather(*[self.recovery_batches[kind].request(self.participants[node_id], trans_id) for node_id in node_ids])
@@ -0,0 +1,87 @@
+import asyncio
+import concurrent.futures
+
+class AsyncConnection:
+    # Runs the blocking calls of a DB-API connection (psycopg2, or e.g. sqlite3 with
+    # check_same_thread=False as a local stand-in) on a worker thread, so the event loop
+    # keeps serving RPCs while queries run. A single worker keeps calls on the connection ordered.
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cur = self.conn.cursor()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def execute(self, query, args=None):
+        if args is None:
+            await self.run(self.cur.execute, query)
+        else:
+            await self.run(self.cur.execute, query, args)
+
+    async def query(self, query, args=None):
+        # Executes and fetches in one call, so no other statement can run on the cursor in between.
+        def run_query():
+            self.cur.execute(query, args)
+            return self.cur.fetchall()
+        return await self.run(run_query)
+
+    async def in_transaction(self, func, *args):
+        # Calls func(cursor, *args) in a transaction that is committed on success and rolled back on error.
+        def run_transaction():
+            with self.conn:
+                return func(self.cur, *args)
+        return await self.run(run_transaction)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+def close_opened(connecting):
+    if not connecting.cancelled() and not connecting.exception():
+        connecting.result().close()
+
+class ConnectionPool:
+    # Bounded pool of AsyncConnections, opened on demand by calling connect().
+
+    def __init__(self, connect, size=10):
+        self.connect = connect # callable returning a new DB-API connection
+        self.size = size
+        self.idle = []
+        self.connections = []
+        self.available = asyncio.Semaphore(size)
+
+    async def acquire(self):
+        await self.available.acquire()
+        if self.idle:
+            return self.idle.pop()
+        connecting = asyncio.get_running_loop().run_in_executor(None, self.connect)
+        try:
+            conn = await asyncio.shield(connecting)
+        except BaseException:
+            # Also when cancelled, e.g. by a timeout; the connection may still open then, and is closed at once.
+            connecting.add_done_callback(close_opened)
+            self.available.release()
+            raise
+        connection = AsyncConnection(conn)
+        self.connections.append(connection)
+        return connection
+
+    def release(self, connection):
+        self.idle.append(connection)
+        self.available.release()
+
+    async def execute(self, query, args=None):
+        connection = await self.acquire()
+        try:
+            await connection.execute(query, args)
+        finally:
+            self.release(connection)
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+            connection.conn.close()
+        self.connections = []
+        self.idle = []
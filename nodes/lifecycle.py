@@ -0,0 +1,32 @@
+import asyncio
+import logging
+import signal
+
+log = logging.getLogger(__name__)
+
+async def wait_for_shutdown():
+    # Sleeps until SIGINT or SIGTERM is received, without using the CPU in the meantime.
+    loop = asyncio.get_running_loop()
+    shutdown = loop.create_future()
+
+    def request_shutdown(signum):
+        log.info("Received %s; shutting down.", signal.Signals(signum).name)
+        if not shutdown.done():
+            shutdown.set_result(signum)
+
+    signums = [signal.SIGINT, signal.SIGTERM]
+    for signum in signums:
+        loop.add_signal_handler(signum, request_shutdown, signum)
+    try:
+        return await shutdown
+    finally:
+        for signum in signums:
+            loop.remove_signal_handler(signum)
+
+async def shut_down(nodes, drain_timeout):
+    # Nodes are drained and stopped in order, so the coordinator should come first: its in-flight
+    # transactions can only finish while the participants still answer.
+    for node in nodes:
+        await node.drain(drain_timeout)
+        await node.stop()
+        log.info("Shut down node on %s:%s.", node.server.server_host, node.server.server_port)
@@ -0,0 +1,59 @@
+import asyncio
+import logging
+
+log = logging.getLogger(__name__)
+
+class GroupCommitLogWriter:
+
+    def __init__(self, log_store, flush_window=0.002, max_batch_size=128):
+        self.log_store = log_store # e.g. nodes.storage.PostgresLog
+        self.flush_window = flush_window # seconds to wait for more transitions before flushing
+        self.max_batch_size = max_batch_size # flush immediately once this many transitions are pending
+        self.pending = {} # transaction_id -> status; a later transition supersedes an earlier one
+        self.waiters = [] # futures resolved once the pending transitions are durable
+        self.flush_task = None
+        self.write_lock = asyncio.Lock() # batches are written in the order they were taken from pending
+        self.flush_count = 0
+
+    async def write(self, trans_id, status):
+        await self.append(trans_id, status)
+
+    def append(self, trans_id, status):
+        # Queues a transition and returns a future that is resolved once it is durable.
+        waiter = asyncio.get_running_loop().create_future()
+        self.pending[trans_id] = status
+        self.waiters.append(waiter)
+        if len(self.pending) >= self.max_batch_size:
+            asyncio.ensure_future(self.flush())
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later())
+        return waiter
+
+    async def flush_later(self):
+        await asyncio.sleep(self.flush_window)
+        await self.flush()
+
+    async def flush(self):
+        if self.flush_task and self.flush_task is not asyncio.current_task():
+            self.flush_task.cancel()
+        self.flush_task = None
+        if not self.pending:
+            return
+        entries = list(self.pending.items())
+        waiters = self.waiters
+        self.pending = {}
+        self.waiters = []
+        try:
+            async with self.write_lock:
+                await self.log_store.write(entries)
+        except Exception as e:
+            # Every transition in the batch fails, not just the StorageErrors of the store, so no waiter hangs.
+            log.error("Could not write %s log entries: %s", len(entries), repr(e))
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+            return
+        self.flush_count += 1
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
@@ -0,0 +1,19 @@
+import logging
+import logging.handlers
+import queue
+import sys
+
+def configure_logging(level="INFO"):
+    # Nodes log through the logging module at DEBUG (every message), INFO (node lifecycle), WARNING (failures
+    # and protocol violations) and ERROR. Records below level are dropped before their message is formatted.
+    # Those that pass are only put on a queue by the event loop; a background thread formats and writes them.
+    # Returns the thread's QueueListener, whose stop() writes the remaining records.
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = logging.handlers.QueueListener(records, handler)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers = [logging.handlers.QueueHandler(records)]
+    listener.start()
+    return listener
@@ -0,0 +1,120 @@
+import asyncio
+import bisect
+import contextlib
+import time
+
+LATENCY_BUCKETS = [0.0001 * 2 ** i for i in range(18)] # upper bounds in seconds, 0.1 ms to about 13 s
+
+class Histogram:
+    __slots__ = ["counts", "count", "sum"]
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1) # the last bucket counts values above every bound
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction):
+        # Upper bound of the bucket holding the given fraction of the observations.
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self):
+        return {"count": self.count, "sum": self.sum, "p50": self.quantile(0.5), "p99": self.quantile(0.99)}
+
+class Metrics:
+    # Counters, gauges and latency histograms of one node. Recording is a dict lookup and an addition, so
+    # it can stay on the hot path; everything else happens when a snapshot is taken.
+
+    def __init__(self, node):
+        self.node = node # label of the node, e.g. "coordinator" or "participant0"
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {} # name -> function returning the current value
+
+    def count(self, name, increment=1):
+        self.counters[name] = self.counters.get(name, 0) + increment
+
+    def observe(self, name, seconds):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        self.histograms[name].observe(seconds)
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def snapshot(self):
+        return {"node": self.node,
+                "counters": dict(self.counters),
+                "gauges": {name: read() for name, read in self.gauges.items()},
+                "latencies": {name: histogram.snapshot() for name, histogram in self.histograms.items()}}
+
+    def render(self):
+        # Prometheus text exposition format.
+        label = f'node="{self.node}"'
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE twopc_{name}_total counter")
+            lines.append(f"twopc_{name}_total{{{label}}} {value}")
+        for name, read in sorted(self.gauges.items()):
+            lines.append(f"# TYPE twopc_{name} gauge")
+            lines.append(f"twopc_{name}{{{label}}} {read()}")
+        for name, histogram in sorted(self.histograms.items()):
+            lines.append(f"# TYPE twopc_{name}_seconds histogram")
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ["+Inf"], histogram.counts):
+                cumulative += count
+                lines.append(f'twopc_{name}_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f"twopc_{name}_seconds_sum{{{label}}} {histogram.sum}")
+            lines.append(f"twopc_{name}_seconds_count{{{label}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+class MetricsServer:
+    # Minimal HTTP endpoint answering GET /metrics with Metrics.render(), for scraping by Prometheus.
+
+    def __init__(self, metrics, hostname, port):
+        self.metrics = metrics
+        self.hostname = hostname
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.hostname, self.port)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()).strip():
+                pass # headers
+            if request_line.split()[:2] == [b"GET", b"/metrics"]:
+                status, body = "200 OK", self.metrics.render()
+            else:
+                status, body = "404 Not Found", "Not found.\n"
+            body = body.encode()
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
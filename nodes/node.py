@@ -1,36 +1,142 @@
-from simplyrpc import RemoteCallServer
+import asyncio
+import concurrent.futures
+import logging
+from nodes.log_writer import GroupCommitLogWriter
+from nodes.metrics import Metrics, MetricsServer
+from nodes.rpc import ConnectionManager, RpcServer
+
+log = logging.getLogger(__name__)
 
 class TwoPhaseCommitNode:
-    def __init__(self, log_db_conn, own_hostname, own_port):
-        self.server = RemoteCallServer(own_hostname, own_port)
+    def __init__(self, log_store, own_hostname, own_port, compaction_interval=30):
+        self.server = RpcServer(own_hostname, own_port)
+        self.server.register_handler("PING", self.recv_ping)
+        self.server.register_handler("STATS", self.recv_stats)
+        self.server.register_handler("BATCH", self.recv_batch)
+        self.connections = ConnectionManager() # to the peers this node sends to
         self.transactions = {} # transaction_id -> status
-        self.log_db_conn = log_db_conn # psycopg2.extensions.connection
-        self.log_db_cur = self.log_db_conn.cursor() # psycopg2.extensions.cursor
+        self.log_store = log_store # e.g. nodes.storage.PostgresLog
+        self.log_writer = GroupCommitLogWriter(self.log_store)
+        self.compaction_interval = compaction_interval # seconds between log compaction passes
+        self.compaction_task = None
+        self.presumption = None # None, "abort" or "commit": outcome assumed for transactions the coordinator has no record of
+        self.log_forces = 0 # log writes waited for before continuing
+        self.messages_sent = 0
+        self.draining = False # set once shutdown begins; no new transactions are accepted
+        self.active_requests = 0 # requests whose handlers are still running
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.metrics = Metrics(f"{own_hostname}:{own_port}")
+        self.metrics.gauge("requests_in_flight", lambda: self.active_requests)
+        self.metrics.gauge("messages_sent", lambda: self.messages_sent)
+        self.metrics.gauge("frames_sent", self.frames_sent)
+        self.metrics.gauge("log_forces", lambda: self.log_forces)
+        self.metrics.gauge("log_flushes", lambda: self.log_writer.flush_count)
+        self.metrics.gauge("log_entries_pending", lambda: len(self.log_writer.pending))
+        self.recovery_concurrency = 100 # unfinished transactions resolved at once after a restart
+        self.metrics_port = None # port of the HTTP scrape endpoint, if any
+        self.metrics_server = None
 
     async def start(self):
         await self.server.start()
+        self.connections.start()
+        if self.metrics_port:
+            self.metrics_server = MetricsServer(self.metrics, self.server.server_host, self.metrics_port)
+            await self.metrics_server.start()
+        self.compaction_task = asyncio.create_task(self.compact_log_periodically())
 
     async def stop(self):
-        self.write_log()
+        if self.compaction_task:
+            self.compaction_task.cancel()
+            self.compaction_task = None
+        await self.log_writer.flush()
+        await self.connections.close()
+        if self.metrics_server:
+            await self.metrics_server.stop()
+            self.metrics_server = None
         await self.server.stop()
+        self.log_store.close()
+
+    def register_handler(self, kind, handler):
+        # Handlers are counted while they run, so that drain can wait for the requests in flight.
+        async def counted(data):
+            self.active_requests += 1
+            self.idle.clear()
+            try:
+                return await handler(data)
+            finally:
+                self.active_requests -= 1
+                if self.active_requests == 0:
+                    self.idle.set()
+        self.server.register_handler(kind, counted)
+
+    async def drain(self, timeout):
+        # Stops accepting new transactions and waits up to timeout seconds for the requests in flight.
+        self.draining = True
+        if self.active_requests:
+            log.info("Draining %s requests in flight.", self.active_requests)
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except concurrent.futures.TimeoutError:
+            log.warning("Gave up draining; %s requests still in flight.", self.active_requests)
+
+    async def initialize_log(self):
+        await self.log_store.initialize()
+        log.info("Initialized log.")
+
+    async def log_transition(self, trans_id, status, force=True):
+        # Unforced transitions are written with the next flush, but not waited for. A forced one only takes effect
+        # once it is durable, so that no other request acts on it before; if the write fails, it never does.
+        written = self.log_writer.append(trans_id, status)
+        if not force:
+            self.transactions[trans_id] = status
+            return
+        self.log_forces += 1
+        with self.metrics.timed("log_force"):
+            await written
+        self.transactions[trans_id] = status
+
+    async def send(self, peer, kind, data):
+        # peer is a PeerConnection from self.connections; returns None if it is down or did not reply in time.
+        self.messages_sent += 1
+        return await peer.request(kind, data)
+
+    def frames_sent(self):
+        # Frames written for requests to peers and for replies to them; each may hold many messages.
+        return self.server.counters["frames"] + sum(peer.counters["frames"] for peer in self.connections.peers.values())
+
+    async def recv_batch(self, data):
+        # [kind, [data, ...]]: handles a request of that kind for each item concurrently and returns their results.
+        kind, items = data
+        if kind not in self.server.handlers or kind == "BATCH":
+            log.warning("Cannot batch requests of kind '%s'.", kind)
+            return None
+        handler = self.server.handlers[kind]
+        return await asyncio.gather(*[handler(item) for item in items])
+
+    async def recv_ping(self, data):
+        return True
+
+    async def recv_stats(self, data):
+        return self.metrics.snapshot()
+
+    async def read_log(self):
+        self.transactions = await self.log_store.read()
+
+    async def compact_log(self):
+        await self.log_writer.flush()
+        # Like the log store, keep the newest entry so that transaction IDs keep increasing after a restart.
+        newest = max(self.transactions.keys(), default=None)
+        finished = [trans_id for trans_id, status in self.transactions.items() if status == "DONE" and trans_id != newest]
+        if not finished:
+            return 0
+        for trans_id in finished:
+            del self.transactions[trans_id]
+        await self.log_store.compact()
+        log.info("Compacted log; removed %s DONE transactions.", len(finished))
+        return len(finished)
 
-    def initialize_log(self):
-        self.log_db_cur.execute("create table if not exists log (transaction_id int not null primary key, status varchar(20) not null)")
-        self.log_db_conn.commit()
-        print("Initialized log table.")
-
-    def write_log(self):
-        print("Writing log.")
-        with self.log_db_conn:
-            self.log_db_cur.execute("select * from log")
-            for trans_id, _ in self.log_db_cur.fetchall():
-                if trans_id not in self.transactions:
-                    self.log_db_cur.execute("delete from log where transaction_id = %s", (trans_id,))
-            for trans_id, status in self.transactions.items():
-                self.log_db_cur.execute("insert into log (transaction_id, status) values(%s, %s) on conflict (transaction_id) do update set status = %s", (trans_id, status, status))
-
-    def read_log(self):
-        self.transactions = {}
-        self.log_db_cur.execute("select * from log")
-        for trans_id, status in self.log_db_cur:
-            self.transactions[trans_id] = status
\ No newline at end of file
+    async def compact_log_periodically(self):
+        while True:
+            await asyncio.sleep(self.compaction_interval)
+            await self.compact_log()
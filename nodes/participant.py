@@ -1,180 +1,465 @@
 import asyncio
-import psycopg2.errors
-import psycopg2.extensions
-from simplyrpc import RemoteCallClient
+import concurrent.futures
+import logging
+import time
 from nodes.node import TwoPhaseCommitNode
+from nodes.partitioning import partition_map_from_json
+from nodes.recovery import BatchSender, Recovery
+from nodes.storage import StorageError, UnknownTransactionError
+
+log = logging.getLogger(__name__)
+
+EXPORT_CHUNK = 500 # keys deleted per statement when exporting a partition
+SESSION_CHECK_INTERVAL = 1 # seconds between checks for idle BEGUN transactions
 
 class TwoPhaseCommitParticipant(TwoPhaseCommitNode):
 
-    def __init__(self, node_id, data_db_conn, log_db_conn, own_hostname, own_port, coordinator_hostname, coordinator_port, timeout=10):
-        super().__init__(log_db_conn, own_hostname, own_port)
+    def __init__(self, node_id, data_store, log_store, own_hostname, own_port, coordinators, timeout=10, peers=()):
+        super().__init__(log_store, own_hostname, own_port)
         self.node_id = node_id
-        self.coordinator = RemoteCallClient(coordinator_hostname, coordinator_port)
         self.timeout = timeout
-        self.coordinator.timeout = self.timeout
-        self.data_db_conn = data_db_conn
-        self.data_db_conn.autocommit = True
-        self.data_db_cur = self.data_db_conn.cursor()
-        self.server.register_handler("EXECUTE", self.recv_execute)
-        self.server.register_handler("PREPARE", self.recv_prepare)
-        self.server.register_handler("COMMIT", self.recv_commit)
-        self.server.register_handler("ABORT", self.recv_abort)
-        self.current_trans_id = None
+        # PeerConnections of the coordinators sharing this participant; coordinator i owns the transaction IDs
+        # that are i modulo their number (see TwoPhaseCommitCoordinator.shard).
+        self.coordinators = [self.connections.peer(hostname, port, self.timeout) for hostname, port in coordinators]
+        # PeerConnections of the other participants, asked for the outcome of a prepared transaction when its
+        # coordinator cannot be reached (cooperative termination).
+        self.peers = [self.connections.peer(hostname, port, self.timeout) for hostname, port in peers]
+        self.max_termination_interval = 30 # seconds between termination attempts, at most
+        self.terminations = {} # transaction_id -> task waiting for the decision on a PREPARED transaction
+        self.preparing = {} # transaction_id -> future of the vote on a BEGUN transaction being prepared
+        self.abort_requests = {} # transaction_id -> force of an ABORT received while preparing, carried out by prepare
+        # DONE acknowledgements are not sent one by one: they go along with the next PREPARE vote for the same
+        # coordinator, or in one DONE_BATCH ack_interval seconds after the first was queued.
+        self.ack_interval = 0.01
+        self.pending_acks = {} # coordinator PeerConnection -> IDs of transactions to acknowledge
+        self.ack_task = None
+        self.data_store = data_store # e.g. nodes.storage.PostgresDataStore
+        self.sessions = {} # transaction_id -> future of the data store session of a BEGUN transaction
+        # BEGUN transactions that receive no statement for session_timeout seconds, e.g. because their coordinator
+        # crashed, are aborted, so that they do not hold a pooled connection and their locks forever.
+        self.session_timeout = 60
+        self.active_at = {} # transaction_id -> time.monotonic() of the last request for a BEGUN transaction
+        self.expiry_task = None
+        self.written = set() # BEGUN transactions that executed a statement other than SELECT
+        self.metrics.gauge("open_sessions", lambda: len(self.sessions))
+        self.register_handler("EXECUTE", self.recv_execute)
+        self.register_handler("EXECUTE_BATCH", self.recv_execute_batch)
+        self.register_handler("EXPORT", self.recv_export)
+        self.register_handler("PREPARE", self.recv_prepare)
+        self.register_handler("PREPARE_VOTE", self.recv_prepare_vote)
+        self.register_handler("COMMIT", self.recv_commit)
+        self.register_handler("COMMIT_ONE_PHASE", self.recv_commit_one_phase)
+        self.register_handler("ABORT", self.recv_abort)
+        self.register_handler("QUERY_OUTCOME", self.recv_query_outcome)
 
     async def setup(self):
-        self.initialize_log()
-        with self.data_db_conn:
-            self.data_db_cur.execute("create table if not exists data(sensor_id varchar(255) not null primary key, measurement int not null)")
+        await self.initialize_log()
+        await self.data_store.initialize()
 
     async def start(self):
         await super().start()
         await self.recover()
+        self.expiry_task = asyncio.create_task(self.expire_sessions_periodically())
 
     async def stop(self):
-        self.data_db_conn.rollback()
-        if self.coordinator:
-            await self.coordinator.disconnect()
+        if self.expiry_task:
+            self.expiry_task.cancel()
+            self.expiry_task = None
+        for termination in list(self.terminations.values()):
+            termination.cancel()
+        for trans_id in list(self.sessions):
+            await self.do_abort(trans_id)
+        await self.send_acks()
         await super().stop()
 
     async def begin_transaction(self, trans_id):
-        if self.current_trans_id == trans_id:
-            return True
+        # Returns the data store session the transaction runs in, or None if it may not be (re)opened.
+        self.active_at[trans_id] = time.monotonic()
+        if trans_id in self.sessions:
+            return await self.sessions[trans_id]
         if trans_id in self.transactions:
-            if self.transactions[trans_id] != "BEGUN":
-                print(f"Trying to append to transaction {trans_id} that is already completed or prepared.")
-                return False
+            del self.active_at[trans_id]
+            log.warning("Trying to append to transaction %s that is already completed or prepared.", trans_id)
+            return None
+        self.transactions[trans_id] = "BEGUN"
+        self.sessions[trans_id] = asyncio.ensure_future(self.open_session(trans_id))
+        return await self.sessions[trans_id]
 
-        previous_id = self.current_trans_id
-        if previous_id in self.transactions:
-            if self.transactions[previous_id] == "BEGUN":
-                print("Aborting previous transaction because a new one was begun.")
-                self.do_abort(previous_id)
+    async def open_session(self, trans_id):
+        try:
+            session = await asyncio.wait_for(self.data_store.begin(), self.timeout)
+        except (concurrent.futures.TimeoutError, StorageError) as e:
+            log.warning("Could not begin transaction %s in database: %s", trans_id, e)
+            self.end_session(trans_id)
+            await self.log_transition(trans_id, "ABORTED")
+            return None
+        log.debug("BEGAN new transaction %s.", trans_id)
+        return session
 
-        self.current_trans_id = trans_id
-        self.transactions[trans_id] = "BEGUN"
-        self.data_db_cur.execute("begin")
-        print(f"BEGAN new transaction {self.current_trans_id}.")
-        return True
+    def end_session(self, trans_id):
+        self.sessions.pop(trans_id, None)
+        self.active_at.pop(trans_id, None)
+        self.written.discard(trans_id)
+
+    async def expire_sessions_periodically(self):
+        while True:
+            await asyncio.sleep(SESSION_CHECK_INTERVAL)
+            idle_since = time.monotonic() - self.session_timeout
+            expired = [trans_id for trans_id in self.sessions if trans_id not in self.preparing and self.active_at.get(trans_id, idle_since) < idle_since]
+            for trans_id in expired:
+                log.warning("Aborting transaction %s; no request for it in %ss.", trans_id, self.session_timeout)
+            await asyncio.gather(*[self.do_abort(trans_id) for trans_id in expired])
+
+    def coordinator_for(self, trans_id):
+        return self.coordinators[trans_id % len(self.coordinators)]
 
     async def recv_execute(self, data):
         trans_id, query, args = data
 
-        if trans_id != self.current_trans_id:
-            begun = await self.begin_transaction(trans_id)
-            if not begun:
-                return False
+        session = await self.begin_transaction(trans_id)
+        if not session:
+            return False
 
-        print(f"EXECUTE ({query}) for transaction {trans_id} in database.")
+        log.debug("EXECUTE (%s) for transaction %s in database.", query, trans_id)
+        if not query.lstrip().lower().startswith("select"):
+            self.written.add(trans_id)
         try:
-            self.data_db_cur.execute(query, args)
-            print("Done.")
-        except psycopg2.Error as e:
-            self.do_abort(trans_id)
-            print(f"EXECUTE failed: {str(e)}")
+            with self.metrics.timed("execute"):
+                await session.execute(query, args)
+            log.debug("Done.")
+        except StorageError as e:
+            await self.do_abort(trans_id)
+            log.info("EXECUTE failed: %s", e)
             return False
         return True
 
-    async def recv_prepare(self, trans_id):
-        if trans_id in self.transactions:
-            status = self.transactions[trans_id]
-            if status == "PREPARED":
-                await self.coordinator.send_timeout("PREPARE", (self.node_id, trans_id, "COMMIT"))
-                return True
-            elif status == "ABORTED":
-                await self.coordinator.send_timeout("PREPARE", (self.node_id, trans_id, "ABORT"))
-                return True
-            elif status == "COMMITTED":
-                print("Received invalid PREPARE message; coordinator already told us to commit.")
-                return False
-            assert status == "BEGUN"
+    async def recv_execute_batch(self, data):
+        trans_id, statements = data
+        results = []
+        for query, args in statements:
+            results.append(await self.recv_execute((trans_id, query, args)))
+        return results
 
+    async def recv_export(self, data):
+        # Moves a partition away while rebalancing: its rows are deleted in the given transaction and returned,
+        # and the coordinator inserts them on their new owner in the same transaction.
+        trans_id, description, partition = data
+        session = await self.begin_transaction(trans_id)
+        if not session:
+            return None
+        partition_map = partition_map_from_json(description, [self.node_id])
+        self.written.add(trans_id)
+        try:
+            rows = [row for row in await session.query("select sensor_id, measurement from data") if partition_map.partition(row[0]) == partition]
+            for start in range(0, len(rows), EXPORT_CHUNK):
+                keys = [sensor_id for sensor_id, _ in rows[start:start + EXPORT_CHUNK]]
+                await session.execute(f"delete from data where sensor_id in ({', '.join(['%s'] * len(keys))})", tuple(keys))
+        except StorageError as e:
+            await self.do_abort(trans_id)
+            log.info("EXPORT failed: %s", e)
+            return None
+        log.debug("EXPORTED %s rows of partition %s in transaction %s.", len(rows), partition, trans_id)
+        return [list(row) for row in rows]
+
+    async def recv_prepare(self, trans_id):
+        vote = await self.prepare(trans_id)
+        if not vote:
+            return False
+        self.metrics.count(f"{vote.lower()}_votes")
+        coordinator = self.coordinator_for(trans_id)
+        acks = self.pending_acks.pop(coordinator, None)
+        if acks:
+            acknowledged = await self.send(coordinator, "PREPARE", (self.node_id, trans_id, vote, acks))
+            await self.acknowledged(acks, acknowledged is not None)
         else:
-            begun = await self.begin_transaction(trans_id)
-            assert begun
+            await self.send(coordinator, "PREPARE", (self.node_id, trans_id, vote))
+        log.debug("Sent PREPARE %s %s to coordinator.", vote, trans_id)
+        self.await_decision(trans_id)
+        return True
+
+    async def recv_prepare_vote(self, trans_id):
+        # Like PREPARE, but the vote is returned in the response instead of a separate message to the coordinator.
+        vote = await self.prepare(trans_id)
+        if vote:
+            self.metrics.count(f"{vote.lower()}_votes")
+        log.debug("Replying PREPARE %s %s to coordinator.", vote, trans_id)
+        self.await_decision(trans_id)
+        return vote
+
+    async def prepare(self, trans_id):
+        # Returns the vote ("COMMIT", "ABORT" or "READ_ONLY"), or None if the transaction can no longer be prepared.
+        if trans_id not in self.transactions:
+            # Only a transaction known to have run nothing but SELECTs here is read-only. Without a record, an EXECUTE
+            # may have been lost, or this participant restarted before preparing, so committing could lose writes.
+            log.info("Received PREPARE for unknown transaction %s; voting ABORT.", trans_id)
+            return "ABORT"
+        status = self.transactions[trans_id]
+        if status == "PREPARED":
+            return "COMMIT"
+        elif status == "ABORTED":
+            return "ABORT"
+        elif status in ["COMMITTED", "DONE"]:
+            log.warning("Received invalid PREPARE message; transaction %s is already %s.", trans_id, status)
+            return None
+        assert status == "BEGUN"
+        if trans_id in self.preparing:
+            return await asyncio.shield(self.preparing[trans_id])
+
+        session = await self.begin_transaction(trans_id)
+        if not session:
+            return "ABORT"
 
-        assert self.current_trans_id == trans_id
         assert self.transactions[trans_id] == "BEGUN"
+        # While preparing, the transaction cannot be aborted by another participant's QUERY_OUTCOME, and an ABORT
+        # only takes effect once the vote is decided.
+        voted = self.preparing[trans_id] = asyncio.get_running_loop().create_future()
+        vote = None
+        try:
+            if trans_id in self.written:
+                vote = await self.prepare_session(trans_id, session)
+            else:
+                vote = await self.release_read_only(trans_id, session)
+        finally:
+            del self.preparing[trans_id]
+            self.abort_requests.pop(trans_id, None)
+            voted.set_result(vote)
+        return vote
+
+    async def prepare_session(self, trans_id, session):
         try:
-            self.data_db_cur.execute("prepare transaction %s", (str(trans_id),))
-        except psycopg2.Error as e:
-            print(f"PREPARE failed in database.")
-            print(str(e))
-            self.do_abort(trans_id)
+            with self.metrics.timed("prepare"):
+                await session.prepare(trans_id)
+        except StorageError as e:
+            log.error("PREPARE failed in database: %s", e)
+            await self.abort(trans_id)
+            return "ABORT"
+        self.end_session(trans_id)
+        await self.log_transition(trans_id, "PREPARED")
+        if trans_id in self.abort_requests:
+            # Rolled back only now, so that the data store does not keep the prepared transaction.
+            log.info("Rolling back transaction %s, which was aborted while it was being prepared.", trans_id)
+            await self.abort(trans_id, self.abort_requests[trans_id])
+            return "ABORT"
+        return "COMMIT"
+
+    async def release_read_only(self, trans_id, session):
+        # Nothing to make durable: finish the transaction locally and forget it without logging.
+        try:
+            await session.commit()
+        except StorageError as e:
+            log.warning("Could not finish read-only transaction %s: %s", trans_id, e)
+        self.end_session(trans_id)
+        del self.transactions[trans_id]
+        if trans_id in self.abort_requests:
+            log.debug("Released read-only transaction %s, which was aborted meanwhile.", trans_id)
+            return "ABORT"
+        log.debug("Released read-only transaction %s.", trans_id)
+        return "READ_ONLY"
+
+    def await_decision(self, trans_id):
+        # Starts the termination protocol for a PREPARED transaction, in case its decision never arrives.
+        if self.transactions.get(trans_id) != "PREPARED" or trans_id in self.terminations:
+            return
+        self.terminations[trans_id] = asyncio.create_task(self.terminate(trans_id))
+        self.terminations[trans_id].add_done_callback(lambda _: self.terminations.pop(trans_id, None))
+
+    async def terminate(self, trans_id):
+        # While the transaction stays PREPARED, its vote is sent to the coordinator again after a timeout, with the
+        # interval doubling each time. If the coordinator is down, the other participants are asked instead, so
+        # that its locks are not held until the coordinator recovers.
+        interval = self.timeout
+        while True:
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, self.max_termination_interval)
+            if self.transactions.get(trans_id) != "PREPARED":
+                return
+            coordinator = self.coordinator_for(trans_id)
+            log.info("No decision on prepared transaction %s yet; sending PREPARE again.", trans_id)
+            await self.send(coordinator, "PREPARE", (self.node_id, trans_id, "COMMIT"))
+            if not coordinator.down or self.transactions.get(trans_id) != "PREPARED":
+                continue
+            outcome = await self.query_outcome(trans_id)
+            if outcome and self.transactions.get(trans_id) == "PREPARED":
+                log.info("Coordinator is down; other participants report transaction %s %s.", trans_id, outcome)
+                self.metrics.count("cooperative_terminations")
+                if outcome == "COMMITTED":
+                    await self.recv_commit(trans_id)
+                else:
+                    await self.recv_abort(trans_id)
+                return
+
+    async def query_outcome(self, trans_id):
+        # Returns "COMMITTED" or "ABORTED" if any other participant knows the outcome, and None otherwise.
+        for outcome in await asyncio.gather(*[self.send(peer, "QUERY_OUTCOME", trans_id) for peer in self.peers]):
+            if outcome in ["COMMITTED", "ABORTED"]:
+                return outcome
+        return None
+
+    async def recv_query_outcome(self, trans_id):
+        # Only participants of a transaction have a record of it, so any record is an answer from the cohort.
+        # A participant that has not voted yet aborts, which guarantees the coordinator cannot commit.
+        # PREPARED participants are as uncertain as the one asking, and a DONE record no longer tells the outcome.
+        status = self.transactions.get(trans_id)
+        if status == "BEGUN" and trans_id not in self.preparing:
+            log.info("Aborting transaction %s on request of another participant; it was never prepared here.", trans_id)
+            await self.do_abort(trans_id)
+            status = self.transactions.get(trans_id)
+        if status in ["COMMITTED", "ABORTED"]:
+            return status
+        return None
+
+    async def recv_commit_one_phase(self, trans_id):
+        # Commits the transaction of which this is the only participant locally, without a prepared transaction or
+        # log entry, and returns True if it committed. A crash before the commit rolls it back in the data store.
+        status = self.transactions.get(trans_id)
+        if status == "ABORTED":
+            # A failed EXECUTE already aborted it; there will be no ABORT from the coordinator to acknowledge.
+            await self.log_transition(trans_id, "DONE", force=False)
+            return False
+        if status != "BEGUN" or trans_id in self.preparing:
+            log.warning("Received illegal one-phase COMMIT; transaction %s has state %s.", trans_id, status)
+            return False
+        session = await self.begin_transaction(trans_id)
+        if not session:
             return False
-        self.transactions[trans_id] = "PREPARED"
-        self.write_log()
-        # if self.node_id == 0:
-        #     return False
-        await self.coordinator.send_timeout("PREPARE", (self.node_id, trans_id, "COMMIT"))
-        print(f"Sent PREPARE COMMIT {trans_id} to coordinator.")
+        self.end_session(trans_id)
+        del self.transactions[trans_id]
+        try:
+            with self.metrics.timed("commit"):
+                await session.commit()
+        except StorageError as e:
+            log.info("One-phase COMMIT of %s failed: %s", trans_id, e)
+            self.metrics.count("aborts")
+            return False
+        self.metrics.count("commits")
+        log.debug("COMMITTED %s into database in one phase.", trans_id)
         return True
 
     async def recv_commit(self, trans_id):
-        status = self.transactions[trans_id]
+        status = self.transactions.get(trans_id, "DONE") # unknown transactions were compacted after DONE
+        if status == "DONE":
+            log.debug("Received redundant COMMIT; transaction %s is already DONE.", trans_id)
+            if self.presumption != "commit":
+                self.queue_done(trans_id)
+            return True
         if status not in ["PREPARED", "COMMITTED"]:
-            print(f"Received illegal COMMIT; transaction {trans_id} has state {status}.")
+            log.warning("Received illegal COMMIT; transaction %s has state %s.", trans_id, status)
             return False
-        self.transactions[trans_id] = "COMMITTED"
-        self.write_log()
+        await self.log_transition(trans_id, "COMMITTED", force=self.presumption != "commit")
         try:
-            self.data_db_cur.execute("commit prepared %s", (str(trans_id),))
-            print(f"COMMITTED {trans_id} into database.")
-        except psycopg2.errors.UndefinedObject:
-            print(f"Received redundant COMMIT; have already committed this transaction {trans_id}.")
+            with self.metrics.timed("commit"):
+                await self.data_store.commit_prepared(trans_id)
+            self.metrics.count("commits")
+            log.debug("COMMITTED %s into database.", trans_id)
+        except UnknownTransactionError:
+            log.debug("Received redundant COMMIT; have already committed this transaction %s.", trans_id)
             pass
-        except psycopg2.Error as e:
-            print("Could not COMMIT!")
-            print(str(e))
-        await self.coordinator.send_timeout("DONE", (self.node_id, trans_id))
-        print(f"Sent DONE to coordinator.")
+        except StorageError as e:
+            log.error("Could not COMMIT %s: %s", trans_id, e)
+        if self.presumption == "commit":
+            await self.log_transition(trans_id, "DONE", force=False)
+        else:
+            self.queue_done(trans_id)
         return True
 
     async def recv_abort(self, trans_id):
-        if (trans_id not in self.transactions or
-                self.transactions[trans_id] not in ["PREPARED", "ABORTED"]):
-            print(f"Received illegal ABORT for transaction {trans_id}.")
+        # Unknown transactions were compacted after DONE, or never reached this participant, e.g. when a
+        # recovering coordinator aborts on every participant because its log does not record which took part.
+        status = self.transactions.get(trans_id, "DONE")
+        if status == "DONE":
+            log.debug("Received redundant ABORT; transaction %s is already DONE.", trans_id)
+            if self.presumption != "abort":
+                self.queue_done(trans_id)
+            return True
+        if status not in ["BEGUN", "PREPARED", "ABORTED"]:
+            log.warning("Received illegal ABORT; transaction %s has state %s.", trans_id, status)
             return False
-        self.do_abort(trans_id)
-        self.write_log()
-        await self.coordinator.send_timeout("DONE", (self.node_id, trans_id))
-        print(f"Sent DONE to coordinator.")
+        await self.do_abort(trans_id, force=self.presumption != "abort")
+        if self.presumption == "abort":
+            await self.log_transition(trans_id, "DONE", force=False)
+        else:
+            self.queue_done(trans_id)
         return True
 
-    def do_abort(self, trans_id):
+    def queue_done(self, trans_id):
+        self.pending_acks.setdefault(self.coordinator_for(trans_id), []).append(trans_id)
+        if not self.ack_task:
+            self.ack_task = asyncio.create_task(self.send_acks_later())
+
+    async def send_acks_later(self):
+        await asyncio.sleep(self.ack_interval)
+        self.ack_task = None
+        await self.send_acks()
+
+    async def send_acks(self):
+        pending, self.pending_acks = self.pending_acks, {}
+        for coordinator, trans_ids in pending.items():
+            with self.metrics.timed("done"):
+                acknowledged = await self.send(coordinator, "DONE_BATCH", (self.node_id, trans_ids))
+            log.debug("Sent DONE for %s transactions to coordinator.", len(trans_ids))
+            await self.acknowledged(trans_ids, acknowledged)
+
+    async def acknowledged(self, trans_ids, received):
+        # Unacknowledged transactions stay COMMITTED or ABORTED; the coordinator sends its decision again when it
+        # recovers, and they are acknowledged then. Acknowledged ones need not be forced: if the DONE entry is lost,
+        # the redundant COMMIT or ABORT after a restart is acknowledged again.
+        if not received:
+            return
+        for trans_id in trans_ids:
+            if self.transactions.get(trans_id) in ["COMMITTED", "ABORTED"]:
+                await self.log_transition(trans_id, "DONE", force=False)
+
+    async def do_abort(self, trans_id, force=True):
+        if trans_id in self.preparing:
+            # Aborting the session now would not stop the data store from preparing the transaction; prepare rolls
+            # it back once it is prepared instead, and votes ABORT.
+            self.abort_requests[trans_id] = force
+            await asyncio.shield(self.preparing[trans_id])
+            return
+        await self.abort(trans_id, force)
+
+    async def abort(self, trans_id, force=True):
         state = self.transactions.get(trans_id, None)
         if state == "ABORTED":
-            print(f"Received redundant ABORT for transaction {trans_id} (in log).")
+            log.debug("Received redundant ABORT for transaction %s (in log).", trans_id)
             return
-        if state == "COMMITTED":
-            print(f"Cannot abort already COMMITTED transaction {trans_id}.")
+        if state in ["COMMITTED", "DONE"]:
+            log.warning("Cannot abort already %s transaction %s.", state, trans_id)
             return
-        self.transactions[trans_id] = "ABORTED"
-        self.write_log()
+        await self.log_transition(trans_id, "ABORTED", force)
+        self.metrics.count("aborts")
         try:
-            if trans_id == self.current_trans_id:
-                self.data_db_cur.execute("abort")
+            if trans_id in self.sessions:
+                session = await self.sessions[trans_id]
+                self.end_session(trans_id)
+                if session:
+                    await session.abort()
             elif state == "PREPARED":
-                self.data_db_cur.execute("rollback prepared %s", (str(trans_id),))
+                await self.data_store.rollback_prepared(trans_id)
             else:
-                assert False
-            print(f"ABORTED {trans_id} in database.")
-        except psycopg2.errors.UndefinedObject:
-            print(f"Received redundant ABORT for transaction {trans_id}.")
+                return
+            log.debug("ABORTED %s in database.", trans_id)
+        except UnknownTransactionError:
+            log.debug("Received redundant ABORT for transaction %s.", trans_id)
             pass
-        except psycopg2.Error as e:
-            print(f"Could not ABORT!")
-            print(e)
+        except StorageError as e:
+            log.error("Could not ABORT %s: %s", trans_id, e)
 
     async def recover(self):
-        self.read_log()
-        awaitables = []
-        print(f"Recovering. {len(self.transactions)} transactions read from log.")
-        for trans_id, status in self.transactions.items():
-            if status == "PREPARED":
-                awaitables.append(asyncio.create_task(self.recv_prepare(trans_id)))
-            elif status == "COMMITTED":
-                awaitables.append(asyncio.create_task(self.recv_commit(trans_id)))
-            elif status == "ABORTED":
-                awaitables.append(asyncio.create_task(self.recv_abort(trans_id)))
-        for awaitable in awaitables:
-            await awaitable
+        await self.read_log()
+        log.info("Recovering. %s transactions read from log.", len(self.transactions))
+        unfinished = [(trans_id, status) for trans_id, status in self.transactions.items() if status in ["PREPARED", "COMMITTED", "ABORTED"]]
+        self.metrics.count("recoveries", len(unfinished))
+        # Votes for prepared transactions are sent to each coordinator in batches.
+        votes = BatchSender(self, "PREPARE")
+        await Recovery(self.metrics, self.recovery_concurrency).run(unfinished, lambda trans_id, status: self.resolve(votes, trans_id, status))
+
+    async def resolve(self, votes, trans_id, status):
+        # Prepared transactions vote again and wait for the decision; decided ones are finished and acknowledged.
+        if status == "PREPARED":
+            await votes.request(self.coordinator_for(trans_id), (self.node_id, trans_id, "COMMIT"))
+            self.await_decision(trans_id)
+        elif status == "COMMITTED":
+            await self.recv_commit(trans_id)
+        elif status == "ABORTED":
+            await self.recv_abort(trans_id)
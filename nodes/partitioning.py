@@ -0,0 +1,125 @@
+import bisect
+import json
+import os
+import zlib
+
+class PartitionMap:
+    # Maps each key of the data table (its sensor_id) to a partition, and each partition to the node ID of the
+    # participant owning it. Subclasses decide how keys are split into partitions; that never changes, so
+    # rebalancing only moves whole partitions between participants.
+
+    def __init__(self, owners):
+        self.owners = list(owners) # partition -> node ID
+        self.pending = None # [partition, target, trans_id] of a move that is being committed
+
+    def owner(self, key):
+        return self.owners[self.partition(key)]
+
+    def partition(self, key):
+        raise NotImplementedError
+
+    def describe(self):
+        # How keys are split into partitions, without the owners; enough for a participant to find a partition's rows.
+        raise NotImplementedError
+
+    def to_json(self):
+        if self.pending:
+            return dict(self.describe(), owners=self.owners, pending=self.pending)
+        return dict(self.describe(), owners=self.owners)
+
+    def rebalanced(self, node_ids, load=None):
+        # Returns new owners for the partitions, spread over node_ids so that each gets about the same load (e.g.
+        # statements routed to each partition; one per partition by default). Partitions of nodes not in node_ids
+        # are moved first; after that, partitions only move from the most to the least loaded node, and only if
+        # that narrows the gap between them, so as little data as possible moves.
+        load = load or [1] * len(self.owners)
+        owners = list(self.owners)
+        node_load = {node_id: 0 for node_id in node_ids}
+        orphans = []
+        for partition, owner in enumerate(owners):
+            if owner in node_load:
+                node_load[owner] += load[partition]
+            else:
+                orphans.append(partition)
+        for partition in sorted(orphans, key=lambda partition: -load[partition]):
+            target = min(node_load, key=node_load.get)
+            owners[partition] = target
+            node_load[target] += load[partition]
+        while True:
+            source = max(node_load, key=node_load.get)
+            target = min(node_load, key=node_load.get)
+            gap = node_load[source] - node_load[target]
+            movable = [partition for partition, owner in enumerate(owners) if owner == source and 0 < load[partition] < gap]
+            if not movable:
+                return owners
+            partition = max(movable, key=lambda partition: load[partition])
+            owners[partition] = target
+            node_load[source] -= load[partition]
+            node_load[target] += load[partition]
+
+class HashPartitionMap(PartitionMap):
+    # Keys are hashed into a fixed number of partitions, which spreads load evenly without knowing the keys.
+
+    def partition(self, key):
+        return zlib.crc32(str(key).encode()) % len(self.owners)
+
+    def describe(self):
+        return {"kind": "hash", "partitions": len(self.owners)}
+
+class RangePartitionMap(PartitionMap):
+    # Partition i holds the keys from boundaries[i - 1] (inclusive) up to boundaries[i] (exclusive), so
+    # neighbouring keys stay on the same participant.
+
+    def __init__(self, boundaries, owners):
+        super().__init__(owners)
+        self.boundaries = sorted(boundaries)
+        if len(self.owners) != len(self.boundaries) + 1:
+            raise ValueError(f"{len(self.boundaries)} range boundaries need {len(self.boundaries) + 1} owners, not {len(self.owners)}.")
+
+    def partition(self, key):
+        return bisect.bisect_right(self.boundaries, str(key))
+
+    def describe(self):
+        return {"kind": "range", "boundaries": self.boundaries}
+
+def spread(partitions, node_ids):
+    # Owners of consecutive partitions in contiguous blocks, as evenly as possible.
+    node_ids = list(node_ids)
+    return [node_ids[partition * len(node_ids) // partitions] for partition in range(partitions)]
+
+def partition_map_from_json(description, node_ids=None):
+    # Without "owners", the partitions are spread over node_ids.
+    kind = description["kind"]
+    if kind == "hash":
+        partitions = description["partitions"]
+        partition_map = HashPartitionMap(description.get("owners") or spread(partitions, node_ids))
+    elif kind == "range":
+        boundaries = description["boundaries"]
+        partition_map = RangePartitionMap(boundaries, description.get("owners") or spread(len(boundaries) + 1, node_ids))
+    else:
+        raise ValueError(f"Unknown partitioning {kind}; expected hash or range.")
+    partition_map.pending = description.get("pending")
+    return partition_map
+
+def parse_partitioning(spec):
+    # "hash:64" or "range:sensor3,sensor6" (keys below sensor3, from sensor3 below sensor6, and the rest).
+    kind, _, parameters = spec.partition(":")
+    if kind == "hash":
+        return {"kind": "hash", "partitions": int(parameters or 64)}
+    elif kind == "range":
+        return {"kind": "range", "boundaries": [boundary for boundary in parameters.split(",") if boundary]}
+    raise ValueError(f"Unknown partitioning {spec}; expected hash:PARTITIONS or range:KEY,KEY,...")
+
+def load_partition_map(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as map_file:
+        return partition_map_from_json(json.load(map_file))
+
+def save_partition_map(partition_map, path):
+    # Written to a temporary file first, so that a crash leaves either the old or the new map.
+    with open(path + ".tmp", "w") as map_file:
+        json.dump(partition_map.to_json(), map_file)
+        map_file.flush()
+        os.fsync(map_file.fileno())
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+class Recovery:
+    # Resolves the unfinished transactions found in the log after a restart, at most `concurrency` at a time, and
+    # logs progress every report_interval seconds. Resolving one usually means waiting for peers, so many run at once.
+
+    def __init__(self, metrics, concurrency=100, report_interval=1):
+        self.metrics = metrics
+        self.concurrency = concurrency
+        self.report_interval = report_interval
+        self.total = 0
+        self.resolved = 0
+
+    async def run(self, transactions, resolve):
+        # transactions: (trans_id, status) pairs; resolve(trans_id, status) finishes one of them.
+        self.total = len(transactions)
+        self.resolved = 0
+        if not transactions:
+            return 0
+        self.metrics.gauge("recovery_pending", lambda: self.total - self.resolved)
+        start = time.perf_counter()
+        pending = iter(transactions)
+
+        async def worker():
+            for trans_id, status in pending:
+                try:
+                    await resolve(trans_id, status)
+                except Exception:
+                    log.exception("Could not recover transaction %s.", trans_id)
+                self.resolved += 1
+
+        reporter = asyncio.create_task(self.report(start))
+        try:
+            await asyncio.gather(*[worker() for _ in range(min(self.concurrency, self.total))])
+        finally:
+            reporter.cancel()
+        duration = time.perf_counter() - start
+        self.metrics.observe("recovery", duration)
+        log.info("Recovered %s transactions in %.2fs.", self.total, duration)
+        return duration
+
+    async def report(self, start):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            rate = self.resolved / (time.perf_counter() - start)
+            log.info("Recovering: %s of %s transactions resolved (%.0f/s).", self.resolved, self.total, rate)
+
+class BatchSender:
+    # Sends the requests of one kind made for the same peer during an iteration of the event loop as a single BATCH
+    # request, which the peer handles concurrently. Each request still gets its own result.
+
+    def __init__(self, node, kind, max_batch=500):
+        self.node = node
+        self.kind = kind
+        self.max_batch = max_batch
+        self.queued = {} # peer -> [(data, future of the result)]
+        self.sends = set()
+
+    def request(self, peer, data):
+        loop = asyncio.get_running_loop()
+        result = loop.create_future()
+        if peer not in self.queued:
+            self.queued[peer] = []
+            loop.call_soon(self.flush, peer)
+        self.queued[peer].append((data, result))
+        if len(self.queued[peer]) >= self.max_batch:
+            self.flush(peer)
+        return result
+
+    def flush(self, peer):
+        batch = self.queued.pop(peer, None)
+        if batch:
+            send = asyncio.create_task(self.send(peer, batch))
+            self.sends.add(send)
+            send.add_done_callback(self.sends.discard)
+
+    async def send(self, peer, batch):
+        results = await self.node.send(peer, "BATCH", [self.kind, [data for data, _ in batch]])
+        for (_, result), value in zip(batch, results or [None] * len(batch)):
+            if not result.done():
+                result.set_result(value)
@@ -0,0 +1,310 @@
+import asyncio
+import concurrent.futures
+import json
+import logging
+import struct
+import time
+import zlib
+
+log = logging.getLogger(__name__)
+
+FRAMED = b"\x02" # first byte of a connection carrying frames; simplyrpc requests start with "{"
+STREAM_LIMIT = 1 << 24 # longest message or frame in bytes
+FRAME_HEADER = struct.Struct("<IB") # length of the body, flags
+COMPRESSED = 1 # flag of a zlib-compressed body
+COMPRESSION_THRESHOLD = 1024 # bodies at least this long are compressed, if that makes them shorter
+# Message kinds are sent as their index in this list; others as strings.
+KINDS = ["PING", "STATS", "BEGIN", "EXECUTE", "EXECUTE_BATCH", "EXPORT", "PREPARE", "PREPARE_VOTE", "COMMIT",
+         "COMMIT_ONE_PHASE", "ABORT", "DONE", "QUERY_OUTCOME", "REBALANCE", "DONE_BATCH", "BATCH"]
+KIND_CODES = {kind: code for code, kind in enumerate(KINDS)}
+
+def encode_frame(messages):
+    # A frame holds any number of requests [id, kind, data] or replies [id, result], in a JSON array.
+    body = json.dumps(messages, separators=(",", ":")).encode()
+    flags = 0
+    if len(body) >= COMPRESSION_THRESHOLD:
+        compressed = zlib.compress(body, 1)
+        if len(compressed) < len(body):
+            body, flags = compressed, COMPRESSED
+    return FRAME_HEADER.pack(len(body), flags) + body
+
+async def read_frame(reader):
+    # Returns the messages of the next frame, or None if the stream ended between frames.
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise
+    length, flags = FRAME_HEADER.unpack(header)
+    if length > STREAM_LIMIT:
+        raise ValueError(f"Frame of {length} bytes is too long.")
+    body = await reader.readexactly(length)
+    if flags & COMPRESSED:
+        body = zlib.decompress(body)
+    return json.loads(body)
+
+class FrameWriter:
+    # Queues the messages for one connection and writes all those queued during an iteration of the event loop as
+    # one frame, so that e.g. the COMMITs and DONEs of many transactions finishing together cost a single write.
+
+    def __init__(self, writer, counters):
+        self.writer = writer
+        self.counters = counters # "frames" and "messages" written, shared by the connections of a node
+        self.queued = []
+
+    def send(self, message):
+        if not self.queued:
+            asyncio.get_running_loop().call_soon(self.flush)
+        self.queued.append(message)
+
+    def flush(self):
+        messages, self.queued = self.queued, []
+        if self.writer.is_closing():
+            return
+        self.writer.write(encode_frame(messages))
+        self.counters["frames"] += 1
+        self.counters["messages"] += len(messages)
+
+    async def drain(self):
+        await self.writer.drain()
+
+def new_counters():
+    return {"frames": 0, "messages": 0}
+
+class RpcServer:
+    # Serves a node's handlers over two protocols. simplyrpc's RemoteCallClient (e.g. in client.py) sends one
+    # request per connection. PeerConnection keeps a connection open and multiplexes requests on it in frames:
+    # each request carries an ID, is handled in its own task and is answered as soon as it is done, in any order.
+
+    def __init__(self, server_host, server_port):
+        self.server_host = server_host
+        self.server_port = server_port
+        self.handlers = {}
+        self.server = None
+        self.connections = {} # task handling a connection -> its writer, closed on stop
+        self.responses = set() # tasks handling framed requests
+        self.counters = new_counters()
+
+    def register_handler(self, kind, handler):
+        if kind in self.handlers:
+            raise KeyError(f"A handler for message kind {kind} already exists.")
+        self.handlers[kind] = handler
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.server_host, self.server_port, limit=STREAM_LIMIT)
+
+    async def stop(self):
+        if not self.server:
+            return # never started, e.g. because setting up the node failed
+        self.server.close()
+        for writer in self.connections.values():
+            writer.close()
+        if self.connections:
+            await asyncio.wait(list(self.connections), timeout=1)
+        await self.server.wait_closed()
+
+    async def handle_connection(self, reader, writer):
+        self.connections[asyncio.current_task()] = writer
+        try:
+            first = await reader.read(1)
+            if first == FRAMED:
+                await self.serve_framed(reader, writer)
+            elif first:
+                request = json.loads(first + (await reader.readuntil(b"\0"))[:-1])
+                result = await self.dispatch(request["kind"], request["data"])
+                writer.write(json.dumps(result).encode() + b"\0")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, KeyError, IndexError, zlib.error) as e:
+            log.warning("Dropped connection after invalid request or connection error: %s", repr(e))
+        finally:
+            writer.close()
+            del self.connections[asyncio.current_task()]
+
+    async def serve_framed(self, reader, writer):
+        frames = FrameWriter(writer, self.counters)
+        while True:
+            requests = await read_frame(reader)
+            if requests is None:
+                return
+            for request_id, kind, data in requests:
+                if isinstance(kind, int):
+                    kind = KINDS[kind]
+                response = asyncio.create_task(self.respond(frames, request_id, kind, data))
+                self.responses.add(response)
+                response.add_done_callback(self.responses.discard)
+
+    async def respond(self, frames, request_id, kind, data):
+        result = await self.dispatch(kind, data)
+        if frames.writer.is_closing():
+            return
+        frames.send([request_id, result])
+        try:
+            await frames.drain()
+        except ConnectionError:
+            pass
+
+    async def dispatch(self, kind, data):
+        if kind not in self.handlers:
+            log.warning("No handler registered for '%s'.", kind)
+            return None
+        try:
+            return await self.handlers[kind](data)
+        except Exception:
+            # Answered like a failed request, so that the sender does not wait for a reply that never comes.
+            log.exception("Handler for '%s' failed.", kind)
+            return None
+
+class PeerConnection:
+    # A persistent connection to a peer's RpcServer, shared by all requests to it. When the peer cannot be
+    # reached or its connection drops, it is marked down and requests fail at once, without waiting for the
+    # timeout, until the next reconnection attempt. Attempts are delayed exponentially after each failure.
+
+    def __init__(self, server_host, server_port, timeout=10, min_backoff=0.1, max_backoff=5):
+        self.server_host = server_host
+        self.server_port = server_port
+        self.timeout = timeout # seconds to wait for a reply
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.reader = None
+        self.writer = None
+        self.frames = None # FrameWriter of the connection
+        self.counters = new_counters()
+        self.receive_task = None
+        self.connecting = None # connection attempt in progress
+        self.pending = {} # request ID -> future of the reply
+        self.next_id = 0
+        self.failures = 0 # consecutive failed connection attempts or dropped connections
+        self.retry_at = 0 # time.monotonic() before which requests fail without trying to reconnect
+
+    @property
+    def down(self):
+        return self.failures > 0
+
+    async def request(self, kind, data=None, timeout=None):
+        # Returns the peer's reply, or None if it is down or did not reply in time.
+        if not await self.connect():
+            return None
+        request_id = self.next_id
+        self.next_id += 1
+        reply = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = reply
+        try:
+            self.frames.send([request_id, KIND_CODES.get(kind, kind), data])
+            await self.frames.drain()
+            return await asyncio.wait_for(reply, timeout or self.timeout)
+        except concurrent.futures.TimeoutError:
+            return None
+        except ConnectionError:
+            self.connection_lost(self.reader)
+            return None
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def connect(self):
+        if self.writer and not self.writer.is_closing():
+            return True
+        if self.down and time.monotonic() < self.retry_at:
+            return False
+        if not self.connecting:
+            self.connecting = asyncio.ensure_future(self.open_connection())
+        return await asyncio.shield(self.connecting)
+
+    async def open_connection(self):
+        try:
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.server_host, self.server_port, limit=STREAM_LIMIT), self.timeout)
+            self.writer.write(FRAMED)
+        except (OSError, concurrent.futures.TimeoutError) as e:
+            self.mark_down(f"cannot connect: {repr(e)}")
+            return False
+        finally:
+            self.connecting = None
+        if self.down:
+            log.info("Peer %s:%s is up again.", self.server_host, self.server_port)
+        self.failures = 0
+        self.frames = FrameWriter(self.writer, self.counters)
+        self.receive_task = asyncio.create_task(self.receive(self.reader))
+        return True
+
+    async def receive(self, reader):
+        try:
+            while True:
+                replies = await read_frame(reader)
+                if replies is None:
+                    # Closed by the peer, e.g. because it shut down.
+                    self.connection_lost(reader, "connection closed", logging.INFO)
+                    return
+                for reply_id, result in replies:
+                    future = self.pending.get(reply_id)
+                    if future and not future.done():
+                        future.set_result(result)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError, zlib.error):
+            self.connection_lost(reader)
+
+    def connection_lost(self, reader, reason="connection lost", level=logging.WARNING):
+        if reader is not self.reader:
+            return # an older connection, already replaced
+        self.close_connection()
+        self.mark_down(reason, level)
+
+    def close_connection(self):
+        if self.writer:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+        self.frames = None
+        # Requests still waiting on the connection get no reply.
+        for future in self.pending.values():
+            if not future.done():
+                future.set_result(None)
+
+    def mark_down(self, reason, level=logging.WARNING):
+        self.failures += 1
+        backoff = min(self.max_backoff, self.min_backoff * 2 ** (self.failures - 1))
+        self.retry_at = time.monotonic() + backoff
+        log.log(level, "Peer %s:%s is down (%s); retrying in %.1fs.", self.server_host, self.server_port, reason, backoff)
+
+    async def ping(self, timeout):
+        # A connected peer that does not answer in time is treated like a dropped connection.
+        if not await self.connect():
+            return False
+        if await self.request("PING", timeout=timeout):
+            return True
+        if self.reader:
+            self.connection_lost(self.reader)
+        return False
+
+    async def close(self):
+        receive_task = self.receive_task
+        self.close_connection()
+        if receive_task:
+            await receive_task
+
+class ConnectionManager:
+    # Keeps one PeerConnection per peer and checks them with a PING every heartbeat_interval seconds, so
+    # that a dead peer is noticed, and a recovered one reconnected, before a transaction needs it.
+
+    def __init__(self, heartbeat_interval=1):
+        self.heartbeat_interval = heartbeat_interval
+        self.peers = {} # (hostname, port) -> PeerConnection
+        self.heartbeat_task = None
+
+    def peer(self, hostname, port, timeout=10):
+        if (hostname, port) not in self.peers:
+            self.peers[(hostname, port)] = PeerConnection(hostname, port, timeout)
+        return self.peers[(hostname, port)]
+
+    def start(self):
+        self.heartbeat_task = asyncio.create_task(self.send_heartbeats())
+
+    async def send_heartbeats(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            await asyncio.gather(*[peer.ping(peer.timeout) for peer in self.peers.values()])
+
+    async def close(self):
+        if self.heartbeat_task:
+            self.heartbeat_task.cancel()
+            self.heartbeat_task = None
+        for peer in self.peers.values():
+            await peer.close()
@@ -0,0 +1,387 @@
+import asyncio
+import concurrent.futures
+import mmap
+import os
+import sqlite3
+import struct
+import zlib
+import psycopg2
+import psycopg2.errors
+import psycopg2.extras
+from nodes.database import AsyncConnection, ConnectionPool
+
+class StorageError(Exception):
+    pass
+
+class UnknownTransactionError(StorageError):
+    # Raised when committing or rolling back a prepared transaction the data store does not know (any more).
+    pass
+
+class PostgresLog:
+
+    def __init__(self, log_db_conn):
+        self.log_db = AsyncConnection(log_db_conn) # wraps a psycopg2.extensions.connection
+
+    async def initialize(self):
+        await self.run(lambda cur: cur.execute("create table if not exists log (transaction_id int not null primary key, status varchar(20) not null)"))
+
+    async def read(self):
+        def select_all(cur):
+            cur.execute("select * from log")
+            return cur.fetchall()
+        return dict(await self.run(select_all))
+
+    async def write(self, entries):
+        await self.run(lambda cur: psycopg2.extras.execute_values(cur, "insert into log (transaction_id, status) values %s on conflict (transaction_id) do update set status = excluded.status", entries))
+
+    async def compact(self):
+        # The newest entry is kept even if DONE, so that transaction IDs keep increasing after a restart.
+        await self.run(lambda cur: cur.execute("delete from log where status = 'DONE' and transaction_id < (select max(transaction_id) from log)"))
+
+    async def run(self, func):
+        try:
+            return await self.log_db.in_transaction(func)
+        except psycopg2.Error as e:
+            raise StorageError(str(e)) from e
+
+    def close(self):
+        self.log_db.close()
+        self.log_db.conn.close()
+
+class SQLiteLog:
+    # Log in a local SQLite database in WAL mode, which saves a network round trip per flush. With
+    # synchronous=full, every commit is synced to disk before write returns.
+
+    def __init__(self, path):
+        self.log_db = AsyncConnection(sqlite3.connect(path, check_same_thread=False))
+
+    async def initialize(self):
+        await self.run(lambda cur: cur.execute("pragma journal_mode=wal"))
+        await self.run(lambda cur: cur.execute("pragma synchronous=full"))
+        await self.run(lambda cur: cur.execute("create table if not exists log (transaction_id int not null primary key, status varchar(20) not null)"))
+
+    async def read(self):
+        def select_all(cur):
+            cur.execute("select * from log")
+            return cur.fetchall()
+        return dict(await self.run(select_all))
+
+    async def write(self, entries):
+        await self.run(lambda cur: cur.executemany("insert into log (transaction_id, status) values (?, ?) on conflict (transaction_id) do update set status = excluded.status", entries))
+
+    async def compact(self):
+        await self.run(lambda cur: cur.execute("delete from log where status = 'DONE' and transaction_id < (select max(transaction_id) from log)"))
+
+    async def run(self, func):
+        try:
+            return await self.log_db.in_transaction(func)
+        except sqlite3.Error as e:
+            raise StorageError(str(e)) from e
+
+    def close(self):
+        self.log_db.close()
+        self.log_db.conn.close()
+
+class FileLog:
+    # Append-only log file of "transaction_id status" lines, the last line for a transaction being its
+    # current state. Each write appends a whole batch from the log writer and syncs it with one fsync.
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) # keeps appends ordered
+
+    async def initialize(self):
+        await self.run(self.open)
+
+    def open(self):
+        # Drops a last line torn by a crash during an append, which was never acknowledged.
+        with open(self.path, "ab+") as log_file:
+            log_file.seek(0)
+            contents = log_file.read()
+            log_file.truncate(contents.rfind(b"\n") + 1)
+        self.file = open(self.path, "a")
+
+    async def read(self):
+        return await self.run(self.read_entries)
+
+    def read_entries(self):
+        entries = {}
+        with open(self.path) as log_file:
+            for line in log_file:
+                trans_id, status = line.split()
+                entries[int(trans_id)] = status
+        return entries
+
+    async def write(self, entries):
+        def append():
+            self.file.write("".join(f"{trans_id} {status}\n" for trans_id, status in entries))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        await self.run(append)
+
+    async def compact(self):
+        await self.run(self.rewrite)
+
+    def rewrite(self):
+        # Writes the remaining entries to a new file that atomically replaces the log.
+        entries = self.read_entries()
+        newest = max(entries.keys(), default=None)
+        compacted_path = self.path + ".compacted"
+        with open(compacted_path, "w") as compacted:
+            for trans_id, status in entries.items():
+                if status != "DONE" or trans_id == newest:
+                    compacted.write(f"{trans_id} {status}\n")
+            compacted.flush()
+            os.fsync(compacted.fileno())
+        self.file.close()
+        os.replace(compacted_path, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.open()
+
+    async def run(self, func):
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func)
+        except (OSError, ValueError) as e:
+            raise StorageError(str(e)) from e
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.file:
+            self.file.close()
+
+class BinaryLog:
+    # Fixed-size binary records in a memory-mapped segment file. A record is the transaction ID, a status
+    # code and a CRC, so a record torn by a crash is recognised and ends the log. Compaction is a checkpoint:
+    # the entries that are still needed are written to a new segment that atomically replaces the old one,
+    # so recovery only scans the checkpoint and the records appended since, not every transaction ever logged.
+
+    MAGIC = b"2PCLOG01"
+    RECORD = struct.Struct("<qB3xI") # transaction_id, status code, CRC32 of the preceding 12 bytes
+    STATUSES = ["BEGUN", "PREPARED", "COMMITTED", "ABORTED", "DONE"] # status code is the index plus one
+
+    def __init__(self, path, segment_size=1 << 20):
+        self.path = path
+        self.segment_size = segment_size # initial size in bytes; a full segment is checkpointed or grown
+        self.entries = {} # transaction_id -> status, as in the current segment
+        self.file = None
+        self.map = None
+        self.end = 0 # offset of the next record
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) # keeps appends ordered
+
+    async def initialize(self):
+        await self.run(self.open)
+
+    def open(self):
+        if not os.path.exists(self.path):
+            self.create_segment(self.path, {}, self.segment_size)
+        self.file = open(self.path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        if self.map[:len(self.MAGIC)] != self.MAGIC:
+            raise StorageError(f"{self.path} is not a binary transaction log.")
+        self.entries, self.end = self.scan()
+
+    def scan(self):
+        # Replays records up to the first empty or torn one.
+        entries = {}
+        offset = self.RECORD.size # the first record slot holds the header
+        while offset + self.RECORD.size <= len(self.map):
+            trans_id, code, crc = self.RECORD.unpack_from(self.map, offset)
+            if code == 0 or crc != zlib.crc32(self.map[offset:offset + 12]):
+                break
+            entries[trans_id] = self.STATUSES[code - 1]
+            offset += self.RECORD.size
+        return entries, offset
+
+    def pack(self, trans_id, status):
+        record = bytearray(self.RECORD.pack(trans_id, self.STATUSES.index(status) + 1, 0))
+        struct.pack_into("<I", record, 12, zlib.crc32(record[:12]))
+        return bytes(record)
+
+    def create_segment(self, path, entries, size):
+        records = b"".join(self.pack(trans_id, status) for trans_id, status in entries.items())
+        size = max(size, self.RECORD.size + 2 * len(records))
+        with open(path, "wb") as segment:
+            segment.write(self.MAGIC.ljust(self.RECORD.size, b"\0"))
+            segment.write(records)
+            segment.truncate(size) # zero-filled, i.e. empty records
+            segment.flush()
+            os.fsync(segment.fileno())
+
+    async def read(self):
+        return dict(self.entries)
+
+    async def write(self, entries):
+        await self.run(self.append, entries)
+
+    def append(self, entries):
+        records = b"".join(self.pack(trans_id, status) for trans_id, status in entries)
+        if self.end + len(records) > len(self.map):
+            self.checkpoint(self.segment_size + len(records))
+        start = self.end
+        self.map[start:start + len(records)] = records
+        # msync needs a page-aligned offset.
+        page_start = start - start % mmap.ALLOCATIONGRANULARITY
+        self.map.flush(page_start, start + len(records) - page_start)
+        self.end += len(records)
+        self.entries.update(entries)
+
+    async def compact(self):
+        await self.run(self.checkpoint, self.segment_size)
+
+    def checkpoint(self, min_size):
+        # Like the other logs, keep the newest entry even if DONE, so that transaction IDs keep increasing.
+        newest = max(self.entries.keys(), default=None)
+        entries = {trans_id: status for trans_id, status in self.entries.items() if status != "DONE" or trans_id == newest}
+        checkpoint_path = self.path + ".checkpoint"
+        self.create_segment(checkpoint_path, entries, min_size)
+        self.close_segment()
+        os.replace(checkpoint_path, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.open()
+
+    def close_segment(self):
+        if self.map:
+            self.map.close()
+            self.map = None
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    async def run(self, func, *args):
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        except (OSError, ValueError) as e:
+            raise StorageError(str(e)) from e
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.close_segment()
+
+class MemoryLog:
+    # Keeps the log in memory; a stand-in for benchmarks and local runs that need no durability.
+
+    def __init__(self, write_delay=0):
+        self.entries = {} # transaction_id -> status
+        self.write_delay = write_delay # seconds each write takes, to simulate a flush to disk
+
+    async def initialize(self):
+        pass
+
+    async def read(self):
+        return dict(self.entries)
+
+    async def write(self, entries):
+        await asyncio.sleep(self.write_delay)
+        self.entries.update(entries)
+
+    async def compact(self):
+        newest = max(self.entries.keys(), default=None)
+        for trans_id in [trans_id for trans_id, status in self.entries.items() if status == "DONE" and trans_id != newest]:
+            del self.entries[trans_id]
+
+    def close(self):
+        pass
+
+class PostgresDataStore:
+
+    def __init__(self, connect, size=10):
+        self.pool = ConnectionPool(connect, size) # connect returns an autocommit psycopg2 connection
+
+    async def initialize(self):
+        await self.run(self.pool.execute, "create table if not exists data(sensor_id varchar(255) not null primary key, measurement int not null)")
+
+    async def begin(self):
+        connection = await self.run(self.pool.acquire)
+        try:
+            await self.run(connection.execute, "begin")
+        except BaseException:
+            # Also when cancelled by a timeout, so that the connection is not lost to the pool.
+            self.pool.release(connection)
+            raise
+        return PostgresSession(self, connection)
+
+    async def commit_prepared(self, trans_id):
+        await self.run(self.pool.execute, "commit prepared %s", (str(trans_id),))
+
+    async def rollback_prepared(self, trans_id):
+        await self.run(self.pool.execute, "rollback prepared %s", (str(trans_id),))
+
+    async def run(self, func, *args):
+        try:
+            return await func(*args)
+        except psycopg2.errors.UndefinedObject as e:
+            raise UnknownTransactionError(str(e)) from e
+        except psycopg2.Error as e:
+            raise StorageError(str(e)) from e
+
+    def close(self):
+        self.pool.close()
+
+class PostgresSession:
+
+    def __init__(self, store, connection):
+        self.store = store
+        self.connection = connection
+
+    async def execute(self, query, args=None):
+        await self.store.run(self.connection.execute, query, args)
+
+    async def query(self, query, args=None):
+        return await self.store.run(self.connection.query, query, args)
+
+    async def prepare(self, trans_id):
+        # The prepared transaction no longer belongs to the connection, so it can serve other transactions.
+        await self.store.run(self.connection.execute, "prepare transaction %s", (str(trans_id),))
+        self.store.pool.release(self.connection)
+
+    async def commit(self):
+        await self.finish("commit")
+
+    async def abort(self):
+        await self.finish("abort")
+
+    async def finish(self, statement):
+        try:
+            await self.store.run(self.connection.execute, statement)
+        finally:
+            self.store.pool.release(self.connection)
+
+def location(url):
+    # "sqlite:///var/log.db" and "sqlite:log.db" both name a path.
+    path = url.partition(":")[2]
+    return path[2:] if path.startswith("//") else path
+
+def open_log_store(url):
+    # postgresql://..., sqlite:PATH, file:PATH, mmap:PATH or memory:
+    scheme = url.partition(":")[0]
+    if scheme in ["postgresql", "postgres"]:
+        return PostgresLog(psycopg2.connect(url))
+    elif scheme == "sqlite":
+        return SQLiteLog(location(url))
+    elif scheme == "file":
+        return FileLog(location(url))
+    elif scheme == "mmap":
+        return BinaryLog(location(url))
+    elif scheme == "memory":
+        return MemoryLog()
+    raise ValueError(f"Unknown log store {url}; expected postgresql://..., sqlite:PATH, file:PATH, mmap:PATH or memory:.")
+
+def open_data_store(url, size=10):
+    # postgresql://...; the SQLite stand-in in benchmarks/local_storage.py is not safe to run participants on.
+    scheme = url.partition(":")[0]
+    if scheme in ["postgresql", "postgres"]:
+        def connect_data_db():
+            data_db = psycopg2.connect(url)
+            data_db.autocommit = True
+            return data_db
+        return PostgresDataStore(connect_data_db, size)
+    raise ValueError(f"Unknown data store {url}; expected postgresql://....")
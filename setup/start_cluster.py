@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import sys
+
+sys.path.append("..")
+
+from nodes.coordinator import TwoPhaseCommitCoordinator
+from nodes.lifecycle import shut_down, wait_for_shutdown
+from nodes.logs import configure_logging
+from nodes.participant import TwoPhaseCommitParticipant
+from nodes.partitioning import parse_partitioning
+from nodes.storage import open_data_store, open_log_store
+
+def hostname_port_type(inp):
+    if ":" in inp:
+        hostname, port = inp.split(":")
+    else:
+        hostname = inp
+        port = 12345
+    return hostname, int(port)
+
+def coordinator_settings(config):
+    # Either a single "coordinator" or a list of "coordinators" sharing the participants.
+    return config.get("coordinators") or [config["coordinator"]]
+
+def make_coordinator(config, shard):
+    coordinators = coordinator_settings(config)
+    settings = coordinators[shard]
+    own_hostname, own_port = hostname_port_type(settings["host"])
+    participant_hosts = [hostname_port_type(participant["host"]) for participant in config["participants"]]
+    coordinator = TwoPhaseCommitCoordinator(open_log_store(settings["log_db"]), own_hostname, own_port, participant_hosts, timeout=config.get("timeout", 10))
+    if settings.get("batch_size"):
+        coordinator.batch_size = settings["batch_size"]
+    coordinator.idle_timeout = settings.get("idle_timeout", 60)
+    coordinator.inline_votes = settings.get("inline_votes", False)
+    coordinator.one_phase = settings.get("one_phase", True)
+    coordinator.shard = shard
+    if settings.get("partitioning"):
+        coordinator.partitioning = parse_partitioning(settings["partitioning"])
+    coordinator.partition_map_path = settings.get("partition_map")
+    coordinator.shards = len(coordinators)
+    coordinator.metrics_port = settings.get("metrics_port")
+    return coordinator
+
+def make_participant(config, node_id, cleanup):
+    settings = config["participants"][node_id]
+    own_hostname, own_port = hostname_port_type(settings["host"])
+    coordinator_hosts = [hostname_port_type(coordinator["host"]) for coordinator in coordinator_settings(config)]
+    peer_hosts = [hostname_port_type(peer["host"]) for peer in config["participants"] if peer is not settings]
+    data_store = open_data_store(settings["data_db"], size=settings.get("max_connections", 10))
+    cleanup.append(data_store.close)
+    participant = TwoPhaseCommitParticipant(node_id, data_store, open_log_store(settings["log_db"]), own_hostname, own_port, coordinator_hosts, timeout=config.get("timeout", 10), peers=peer_hosts)
+    participant.session_timeout = settings.get("session_timeout", 60)
+    participant.metrics_port = settings.get("metrics_port")
+    return participant
+
+async def main():
+    argparser = argparse.ArgumentParser(description="Run a coordinator and its participants in one process, as described by a JSON config file.")
+    argparser.add_argument("config", type=str, help="e.g. cluster.example.json")
+    args = argparser.parse_args()
+    with open(args.config) as config_file:
+        config = json.load(config_file)
+
+    log_listener = configure_logging(config.get("log_level", "INFO"))
+    cleanup = []
+    nodes = []
+    started = []
+    try:
+        # Coordinators come first, so that they are drained while the participants still answer.
+        for shard in range(len(coordinator_settings(config))):
+            nodes.append(make_coordinator(config, shard))
+        for node_id in range(len(config["participants"])):
+            nodes.append(make_participant(config, node_id, cleanup))
+        for node in nodes:
+            node.presumption = config.get("presumption")
+            if config.get("log_flush_window") is not None:
+                node.log_writer.flush_window = config["log_flush_window"]
+            await node.setup()
+        # Participants start first; the coordinators' recovery may need to reach them.
+        for node in reversed(nodes):
+            await node.start()
+            started.insert(0, node)
+        coordinator_hosts = ", ".join(coordinator["host"] for coordinator in coordinator_settings(config))
+        print(f"Cluster of {len(config['participants'])} participants listening; coordinators on {coordinator_hosts}.")
+        await wait_for_shutdown()
+    finally:
+        await shut_down(started, config.get("drain_timeout", 10))
+        for close in cleanup:
+            close()
+        print("Closed data databases.")
+        log_listener.stop()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except (KeyboardInterrupt, concurrent.futures.CancelledError):
+        print("Killed.")
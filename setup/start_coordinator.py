@@ -1,12 +1,15 @@
 import argparse
 import asyncio
 import concurrent.futures
-import psycopg2
 import sys
 
 sys.path.append("..")
 
 from nodes.coordinator import TwoPhaseCommitCoordinator
+from nodes.lifecycle import wait_for_shutdown
+from nodes.logs import configure_logging
+from nodes.partitioning import parse_partitioning
+from nodes.storage import open_log_store
 
 def hostname_port_type(inp):
     if ":" in inp:
@@ -20,29 +23,48 @@ async def main():
     argparser = argparse.ArgumentParser()
     argparser.add_argument("--host", type=hostname_port_type, required=True,)
     argparser.add_argument("--participant", type=hostname_port_type, action="append")
-    argparser.add_argument("--log-db", type=str)
+    argparser.add_argument("--shard", type=int, default=0, help="index of this coordinator among those sharing the participants")
+    argparser.add_argument("--shards", type=int, default=1, help="number of coordinators sharing the participants")
+    argparser.add_argument("--partitioning", type=str, default="hash:64", help="hash:PARTITIONS or range:KEY,KEY,... for statements routed by key")
+    argparser.add_argument("--partition-map", type=str, help="file keeping the partition map across restarts and rebalancing")
+    argparser.add_argument("--log-db", type=str, required=True, help="postgresql://..., sqlite:PATH, file:PATH, mmap:PATH or memory:")
+    argparser.add_argument("--log-flush-window", type=float)
+    argparser.add_argument("--presumption", choices=["abort", "commit"])
+    argparser.add_argument("--drain-timeout", type=float, default=10, help="seconds to wait for requests in flight on shutdown")
     argparser.add_argument("--timeout", type=int, default=10)
+    argparser.add_argument("--idle-timeout", type=float, default=60, help="seconds after which a client's transaction without requests is aborted")
     argparser.add_argument("--batch-size", type=int)
+    argparser.add_argument("--inline-votes", action="store_true")
+    argparser.add_argument("--no-one-phase", action="store_true", help="run two-phase commit even for transactions with a single participant")
+    argparser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics over HTTP at /metrics on this port")
+    argparser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO")
     args = argparser.parse_args()
     own_hostname, own_port = args.host
+    log_listener = configure_logging(args.log_level)
+    the_node = TwoPhaseCommitCoordinator(open_log_store(args.log_db), own_hostname, own_port, args.participant, timeout=args.timeout)
+    if args.batch_size:
+            the_node.batch_size = args.batch_size
+    the_node.idle_timeout = args.idle_timeout
+    the_node.inline_votes = args.inline_votes
+    the_node.one_phase = not args.no_one_phase
+    the_node.shard = args.shard
+    the_node.shards = args.shards
+    the_node.partitioning = parse_partitioning(args.partitioning)
+    the_node.partition_map_path = args.partition_map
+    the_node.presumption = args.presumption
+    the_node.metrics_port = args.metrics_port
+    if args.log_flush_window is not None:
+        the_node.log_writer.flush_window = args.log_flush_window
     try:
-        log_db = psycopg2.connect(args.log_db)
-        the_node = TwoPhaseCommitCoordinator(log_db, own_hostname, own_port, args.participant, timeout=args.timeout)
-        if args.batch_size:
-                the_node.batch_size = args.batch_size
         await the_node.setup()
-        try:
-            await the_node.start()
-            print("{} node listening on {}:{}.".format("Coordinator", own_hostname, own_port))
-            while True:
-                await asyncio.sleep(0)
-        finally:
-            await the_node.stop()
-            print("Shut down communication node.")
+        await the_node.start()
+        print("{} node listening on {}:{}.".format("Coordinator", own_hostname, own_port))
+        await wait_for_shutdown()
+        await the_node.drain(args.drain_timeout)
     finally:
-        if log_db:
-            log_db.close()
-            print("Closed log database connection.")
+        await the_node.stop()
+        print("Shut down communication node and closed log.")
+        log_listener.stop()
 
 if __name__ == "__main__":
     try:
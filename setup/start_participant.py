@@ -1,11 +1,13 @@
 import argparse
 import asyncio
 import concurrent.futures
-import psycopg2
 import sys
 sys.path.append("..")
 
+from nodes.lifecycle import wait_for_shutdown
+from nodes.logs import configure_logging
 from nodes.participant import TwoPhaseCommitParticipant
+from nodes.storage import open_data_store, open_log_store
 
 def hostname_port_type(inp):
     if ":" in inp:
@@ -18,36 +20,45 @@ def hostname_port_type(inp):
 async def main():
     argparser = argparse.ArgumentParser()
     argparser.add_argument("--host", type=hostname_port_type, required=True)
-    argparser.add_argument("--coordinator", type=hostname_port_type)
+    argparser.add_argument("--coordinator", type=hostname_port_type, action="append", required=True, help="repeated for each coordinator, in the order of their --shard")
+    argparser.add_argument("--peer", type=hostname_port_type, action="append", default=[], help="repeated for each other participant, to ask for outcomes while the coordinator is down")
     argparser.add_argument("--node-id", type=int)
-    argparser.add_argument("--data-db", type=str)
-    argparser.add_argument("--log-db", type=str)
+    argparser.add_argument("--data-db", type=str, required=True, help="postgresql://...")
+    argparser.add_argument("--log-db", type=str, required=True, help="postgresql://..., sqlite:PATH, file:PATH, mmap:PATH or memory:")
+    argparser.add_argument("--log-flush-window", type=float)
+    argparser.add_argument("--presumption", choices=["abort", "commit"])
+    argparser.add_argument("--drain-timeout", type=float, default=10, help="seconds to wait for requests in flight on shutdown")
+    argparser.add_argument("--max-connections", type=int, default=10)
+    argparser.add_argument("--session-timeout", type=float, default=60, help="seconds after which a transaction without requests is aborted")
+    argparser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics over HTTP at /metrics on this port")
+    argparser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO")
     args = argparser.parse_args()
     own_hostname, own_port = args.host
     if args.node_id is None:
         print("All participant nodes must be supplied with a consecutive --node-id starting from zero.")
         return 1
+    log_listener = configure_logging(args.log_level)
+    data_store = open_data_store(args.data_db, size=args.max_connections)
     try:
-        log_db = psycopg2.connect(args.log_db)
-        data_db = psycopg2.connect(args.data_db)
-        coordinator_hostname, coordinator_port = args.coordinator
-        the_node = TwoPhaseCommitParticipant(args.node_id, data_db, log_db, own_hostname, own_port, coordinator_hostname, coordinator_port)
-        await the_node.setup()
+        the_node = TwoPhaseCommitParticipant(args.node_id, data_store, open_log_store(args.log_db), own_hostname, own_port, args.coordinator, peers=args.peer)
+        the_node.presumption = args.presumption
+        the_node.session_timeout = args.session_timeout
+        the_node.metrics_port = args.metrics_port
+        if args.log_flush_window is not None:
+            the_node.log_writer.flush_window = args.log_flush_window
         try:
+            await the_node.setup()
             await the_node.start()
             print("{} node listening on {}:{}.".format("Participant", own_hostname, own_port))
-            while True:
-                await asyncio.sleep(0)
+            await wait_for_shutdown()
+            await the_node.drain(args.drain_timeout)
         finally:
             await the_node.stop()
-            print("Shut down communication node.")
+            print("Shut down communication node and closed log.")
     finally:
-        if log_db:
-            log_db.close()
-            print("Closed log database connection.")
-        if data_db:
-            data_db.close()
-            print("Closed data database connection.")
+        data_store.close()
+        print("Closed data database connections.")
+        log_listener.stop()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,83 @@
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+
+from local_storage import SQLiteDataStore
+from nodes.coordinator import TwoPhaseCommitCoordinator
+from nodes.participant import TwoPhaseCommitParticipant
+from nodes.storage import MemoryLog
+
+INSERT = "insert into data (sensor_id, measurement) values (%s, %s)"
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+class Cluster:
+    # A coordinator and participants in this process, with in-memory logs and SQLite data stores in a temporary
+    # directory. Nodes are set up, but only started by start(), so that tests can seed logs or replace methods first.
+
+    def __init__(self, participants=2, timeout=2, coordinator_log=None):
+        self.directory = tempfile.TemporaryDirectory()
+        self.partition_map_path = os.path.join(self.directory.name, "partitions.json")
+        self.timeout = timeout
+        self.coordinator_port = free_port()
+        self.participant_hosts = [("localhost", free_port()) for _ in range(participants)]
+        self.coordinator = self.make_coordinator(coordinator_log or MemoryLog())
+        self.participants = [self.make_participant(node_id) for node_id in range(participants)]
+
+    def make_coordinator(self, log_store):
+        coordinator = TwoPhaseCommitCoordinator(log_store, "localhost", self.coordinator_port, self.participant_hosts, timeout=self.timeout)
+        coordinator.partition_map_path = self.partition_map_path
+        return coordinator
+
+    def make_participant(self, node_id, log_store=None, data_store=None):
+        hostname, port = self.participant_hosts[node_id]
+        data_store = data_store or SQLiteDataStore(os.path.join(self.directory.name, f"data{node_id}.db"))
+        peers = [host for host in self.participant_hosts if host != (hostname, port)]
+        return TwoPhaseCommitParticipant(node_id, data_store, log_store or MemoryLog(), hostname, port,
+                                         [("localhost", self.coordinator_port)], timeout=self.timeout, peers=peers)
+
+    async def setup(self):
+        for node in self.participants + [self.coordinator]:
+            await node.setup()
+
+    async def start(self):
+        for node in self.participants + [self.coordinator]:
+            await node.start()
+
+    async def restart_coordinator(self):
+        # Stops the coordinator without finishing anything, as if it crashed, and starts a new one on its log.
+        await self.coordinator.connections.close()
+        await self.coordinator.server.stop()
+        for task in [self.coordinator.collection_task, self.coordinator.idle_task, self.coordinator.compaction_task]:
+            if task:
+                task.cancel()
+        self.coordinator = self.make_coordinator(self.coordinator.log_store)
+        await self.coordinator.setup()
+        await self.coordinator.start()
+
+    async def stop(self):
+        for node in [self.coordinator] + self.participants:
+            await node.stop()
+        for participant in self.participants:
+            participant.data_store.close()
+        self.directory.cleanup()
+
+    async def rows(self, node_id):
+        return await self.participants[node_id].data_store.run([("select sensor_id, measurement from data order by sensor_id", None)], False)
+
+async def eventually(condition, timeout=5):
+    # Waits until condition() is true, and returns whether it became true in time.
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
@@ -0,0 +1,153 @@
+import asyncio
+import unittest
+
+from cluster import INSERT, Cluster, eventually
+from nodes.storage import MemoryLog, StorageError
+
+class FailingLog(MemoryLog):
+
+    def __init__(self):
+        super().__init__()
+        self.failing = False
+
+    async def write(self, entries):
+        if self.failing:
+            raise StorageError("disk full")
+        await super().write(entries)
+
+class CoordinatorTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.cluster = None
+
+    async def asyncTearDown(self):
+        if self.cluster:
+            await self.cluster.stop()
+
+    def record_sends(self, node):
+        sent = []
+        async def send(peer, kind, data):
+            sent.append((kind, data))
+            return True
+        node.send = send
+        return sent
+
+    async def test_decision_takes_effect_once_durable(self):
+        self.cluster = Cluster(coordinator_log=MemoryLog(write_delay=0.3))
+        await self.cluster.setup()
+        coordinator = self.cluster.coordinator
+        sent = self.record_sends(coordinator)
+        await coordinator.reserve_trans_ids()
+        ctx = coordinator.begin_transaction()
+        ctx.add_participant(0)
+        await coordinator.set_state(ctx, "PREPARED")
+        deciding = asyncio.create_task(coordinator.set_state(ctx, "COMMITTED"))
+        await asyncio.sleep(0.1)
+        # A vote sent again while the decision is being forced still finds the transaction PREPARED.
+        self.assertTrue(await coordinator.recv_prepare((0, ctx.trans_id, "COMMIT")))
+        self.assertNotIn(("COMMIT", ctx.trans_id), sent)
+        self.assertEqual(coordinator.transactions[ctx.trans_id], "PREPARED")
+        await deciding
+        self.assertEqual(coordinator.transactions[ctx.trans_id], "COMMITTED")
+
+    async def test_failed_decision_does_not_take_effect(self):
+        log_store = FailingLog()
+        self.cluster = Cluster(coordinator_log=log_store)
+        await self.cluster.setup()
+        coordinator = self.cluster.coordinator
+        await coordinator.reserve_trans_ids()
+        ctx = coordinator.begin_transaction()
+        await coordinator.set_state(ctx, "PREPARED")
+        log_store.failing = True
+        with self.assertRaises(StorageError):
+            await coordinator.set_state(ctx, "COMMITTED")
+        self.assertEqual(coordinator.transactions[ctx.trans_id], "PREPARED")
+        self.assertEqual(ctx.state, "PREPARED")
+
+    async def lose_execute_batch(self, deliver):
+        # Participant 1 gets no EXECUTE_BATCH (or its reply is lost, if deliver is set) in a committing EXECUTE_BATCH.
+        self.cluster = Cluster()
+        await self.cluster.setup()
+        await self.cluster.start()
+        coordinator = self.cluster.coordinator
+        send = coordinator.send
+        async def lossy_send(peer, kind, data):
+            if kind == "EXECUTE_BATCH" and peer is coordinator.participants[1]:
+                if deliver:
+                    await send(peer, kind, data)
+                return None
+            return await send(peer, kind, data)
+        coordinator.send = lossy_send
+        reply = await coordinator.recv_execute_batch({"statements": [[0, INSERT, ["a", 1]], [1, INSERT, ["b", 1]]], "commit": True})
+        self.assertEqual(reply["results"], [True, False])
+        self.assertFalse(reply["committed"])
+        self.assertEqual(await self.cluster.rows(0), [])
+        self.assertEqual(await self.cluster.rows(1), [])
+
+    async def test_lost_execute_aborts(self):
+        await self.lose_execute_batch(deliver=False)
+
+    async def test_lost_execute_reply_aborts(self):
+        await self.lose_execute_batch(deliver=True)
+
+    async def test_restart_does_not_reuse_transaction_ids(self):
+        self.cluster = Cluster()
+        await self.cluster.setup()
+        await self.cluster.start()
+        orphan = await self.cluster.coordinator.recv_begin({})
+        self.assertTrue(await self.cluster.coordinator.recv_execute({"trans_id": orphan, "node_id": 0, "query": INSERT, "args": ["orphan", 1]}))
+        await self.cluster.restart_coordinator()
+        coordinator = self.cluster.coordinator
+        trans_id = await coordinator.recv_begin({})
+        self.assertNotEqual(trans_id, orphan)
+        self.assertTrue(await coordinator.recv_execute({"trans_id": trans_id, "node_id": 0, "query": INSERT, "args": ["fresh", 2]}))
+        self.assertTrue(await coordinator.recv_commit({"trans_id": trans_id}))
+        self.assertEqual(await self.cluster.rows(0), [("fresh", 2)])
+
+    async def test_rejected_statement_aborts(self):
+        self.cluster = Cluster()
+        await self.cluster.setup()
+        await self.cluster.start()
+        reply = await self.cluster.coordinator.recv_execute_batch({"statements": [[0, INSERT, ["a", 1]], [7, INSERT, ["b", 1]]], "commit": True})
+        self.assertFalse(reply["committed"])
+        self.assertEqual(await self.cluster.rows(0), [])
+
+    async def test_empty_transaction_does_not_commit(self):
+        self.cluster = Cluster()
+        await self.cluster.setup()
+        await self.cluster.start()
+        coordinator = self.cluster.coordinator
+        trans_id = await coordinator.recv_begin({})
+        self.assertFalse(await coordinator.recv_execute({"trans_id": trans_id, "node_id": 7, "query": INSERT, "args": ["a", 1]}))
+        self.assertFalse(await coordinator.recv_commit({"trans_id": trans_id}))
+        self.assertEqual(coordinator.transactions[trans_id], "DONE")
+
+    async def test_restart_settles_committed_move(self):
+        self.cluster = Cluster()
+        await self.cluster.setup()
+        await self.cluster.start()
+        coordinator = self.cluster.coordinator
+        reply = await coordinator.recv_execute_batch({"statements": [[{"key": "a"}, INSERT, ["a", 1]]], "commit": True})
+        self.assertTrue(reply["committed"])
+        partition = coordinator.partition_map.partition("a")
+        source = coordinator.partition_map.owners[partition]
+        target = 1 - source
+        def crash(moved):
+            raise RuntimeError("crashed")
+        coordinator.settle_move = crash
+        # The coordinator stops after the move committed, but before the map was updated.
+        with self.assertRaises(RuntimeError):
+            await coordinator.migrate(partition, source, target)
+        self.assertEqual(await self.cluster.rows(source), [])
+        trans_id = coordinator.partition_map.pending[2]
+        self.assertTrue(await eventually(lambda: coordinator.transactions.get(trans_id) == "DONE"))
+        await coordinator.collect_finished()
+        await coordinator.log_writer.flush()
+        await self.cluster.restart_coordinator()
+        coordinator = self.cluster.coordinator
+        self.assertEqual(coordinator.partition_map.owners[partition], target)
+        self.assertIsNone(coordinator.partition_map.pending)
+        self.assertEqual(await self.cluster.rows(target), [("a", 1)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,25 @@
+import asyncio
+import sqlite3
+import time
+import unittest
+
+import cluster # sets up the import path
+from nodes.database import ConnectionPool
+
+class ConnectionPoolTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_timed_out_acquire_releases_its_permit(self):
+        def slow_connect():
+            time.sleep(0.2)
+            return sqlite3.connect(":memory:", check_same_thread=False)
+        pool = ConnectionPool(slow_connect, size=2)
+        for _ in range(2):
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(pool.acquire(), 0.05)
+        connection = await asyncio.wait_for(pool.acquire(), 1)
+        self.assertEqual(len(pool.connections), 1)
+        pool.release(connection)
+        pool.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import asyncio
+import unittest
+
+from cluster import INSERT, Cluster, eventually
+
+SELECT = "select measurement from data where sensor_id = %s"
+
+class ParticipantTest(unittest.IsolatedAsyncioTestCase):
+    # Calls a participant's handlers directly, as its coordinator would; the coordinator is not running.
+
+    async def asyncSetUp(self):
+        self.cluster = Cluster(participants=2, timeout=1)
+        await self.cluster.setup()
+        self.participant = self.cluster.participants[0]
+
+    async def asyncTearDown(self):
+        await self.cluster.stop()
+
+    def slow_sessions(self, method, delay=0.2):
+        # Makes the given method of the data store's sessions wait before doing its work.
+        data_store = self.participant.data_store
+        begin = data_store.begin
+        async def slow_begin():
+            session = await begin()
+            work = getattr(session, method)
+            async def slow(*args):
+                await asyncio.sleep(delay)
+                return await work(*args)
+            setattr(session, method, slow)
+            return session
+        data_store.begin = slow_begin
+
+    async def test_unknown_transaction_votes_abort(self):
+        self.assertEqual(await self.participant.prepare(7), "ABORT")
+
+    async def test_abort_while_preparing_rolls_back(self):
+        self.slow_sessions("prepare")
+        self.assertTrue(await self.participant.recv_execute((7, INSERT, ("a", 1))))
+        preparing = asyncio.create_task(self.participant.prepare(7))
+        await asyncio.sleep(0.05)
+        self.assertTrue(await self.participant.recv_abort(7))
+        # The ABORT returns only once the prepared transaction is rolled back, and the vote is ABORT.
+        self.assertEqual(self.participant.data_store.prepared, {})
+        self.assertEqual(await preparing, "ABORT")
+        self.assertEqual(self.participant.transactions[7], "ABORTED")
+
+    async def test_query_outcome_while_releasing_read_only(self):
+        self.slow_sessions("commit")
+        self.assertTrue(await self.participant.recv_execute((7, SELECT, ("a",))))
+        preparing = asyncio.create_task(self.participant.prepare(7))
+        await asyncio.sleep(0.05)
+        # Another participant asking must not be told ABORTED when the vote may still be READ_ONLY.
+        self.assertIsNone(await self.participant.recv_query_outcome(7))
+        self.assertEqual(await preparing, "READ_ONLY")
+
+    async def test_abort_while_releasing_read_only(self):
+        self.slow_sessions("commit")
+        self.assertTrue(await self.participant.recv_execute((7, SELECT, ("a",))))
+        preparing = asyncio.create_task(self.participant.prepare(7))
+        await asyncio.sleep(0.05)
+        self.assertTrue(await self.participant.recv_abort(7))
+        self.assertEqual(await preparing, "ABORT")
+
+    async def test_idle_session_expires(self):
+        self.participant.session_timeout = 0.2
+        await self.participant.start()
+        self.assertTrue(await self.participant.recv_execute((7, INSERT, ("a", 1))))
+        self.assertTrue(await eventually(lambda: 7 not in self.participant.sessions))
+        self.assertEqual(self.participant.transactions[7], "ABORTED")
+
+if __name__ == "__main__":
+    unittest.main()